@@ -0,0 +1,61 @@
+import os, sys, time, shutil, glob, tempfile, argparse, logging
+
+pjoin = os.path.join
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+if file_dir not in sys.path:
+    sys.path.append(file_dir)
+
+from src.parse_data import DataParser
+from src.config_utils import setup_logging
+from rich.console import Console
+from rich.table import Table
+
+def make_batch(sample_dir, batch_dir, n_files):
+    """Copy the sample surveys into batch_dir until it holds n_files survey files."""
+    samples = sorted(glob.glob(pjoin(sample_dir, '320*.txt')))
+    os.makedirs(batch_dir, exist_ok=True)
+    inputs = []
+    for i in range(n_files):
+        sample = samples[i % len(samples)]
+        target = pjoin(batch_dir, f"{i:05d}_{os.path.basename(sample)}")
+        shutil.copyfile(sample, target)
+        inputs.append(target)
+    return inputs
+
+def bench_parse(n_files, worker_counts, comp_type='modules'):
+    """Time DataParser on a batch of n_files copies of the sample surveys for each worker count."""
+    sample_dir = pjoin(file_dir, 'templates', 'samples')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = make_batch(sample_dir, pjoin(tmp, 'surveys', comp_type), n_files)
+        for workers in worker_counts:
+            output_dir = pjoin(tmp, f'parsed_{workers}', comp_type)
+            parser = DataParser(inputs, output_dir, workers=workers)
+            start = time.perf_counter()
+            parser()
+            elapsed = time.perf_counter() - start
+            results.append((workers, elapsed, n_files / elapsed))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark DataParser throughput against the number of worker processes.")
+    parser.add_argument("--files", type=int, default=2000, help="Number of survey files in the batch.")
+    parser.add_argument("--workers", type=int, nargs='+', default=None, help="Worker counts to benchmark. Defaults to powers of two up to the number of cores.")
+    args = parser.parse_args()
+
+    setup_logging(logging.WARNING)
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, cores} | {2**i for i in range(cores.bit_length()) if 2**i <= cores})
+
+    results = bench_parse(args.files, worker_counts)
+    baseline = results[0][1]
+
+    table = Table(title=f"DataParser throughput ({args.files} files, {cores} cores)")
+    table.add_column("Workers", justify="center", style="cyan")
+    table.add_column("Time (s)", justify="right", style="green")
+    table.add_column("Files/s", justify="right", style="green")
+    table.add_column("Speedup", justify="right", style="yellow")
+    for workers, elapsed, throughput in results:
+        table.add_row(str(workers), f"{elapsed:.2f}", f"{throughput:.0f}", f"{baseline / elapsed:.2f}x")
+    Console().print(table)
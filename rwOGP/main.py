@@ -1,4 +1,5 @@
 import os, yaml, sys, asyncio, logging, glob, argparse
+from contextlib import contextmanager
 from datetime import datetime
 from rich_argparse import RichHelpFormatter
 from rich.table import Table
@@ -12,8 +13,10 @@ if src_dir not in sys.path:
     sys.path.append(src_dir)
 
 from src.auto_upload import InventoryUpdater
-from src.config_utils import load_config, create_default_config, update_credentials, update_directorys, verify_config, setup_logging
-from src.invent_utils import invent_print, clear_invent
+from src.watcher import SurveyWatcher
+from src.config_utils import load_config, create_default_config, update_credentials, update_directorys, verify_config, setup_logging, SETTINGS_FILE
+from src.profiling import RunProfiler
+from src.invent_utils import invent_print, clear_invent, clear_parse_cache, index_print
 from src.workflow_tester import test_module_workflow, test_angle_calculations
 
 program_descriptions = """This program is used to automatically upload results to the OGP database. 
@@ -23,8 +26,10 @@ The program will also update the inventory file to reflect the results that have
 
 Running without any arguments will process and upload all new surveys to the OGP database."""
 
-async def main_func(comp_type):
-    """Main function to run the program."""
+async def main_func(comp_type='', watch=False, rescan=False, keep_going=False, profiler=None):
+    """Main function to run the program. With watch, keep running and upload new surveys as they appear.
+    With keep_going, failing surveys do not stop the batch (overrides `continue_on_error` in the configuration file).
+    With a profiler (RunProfiler), the processing stages are profiled separately."""
     settings = load_config()
     if settings is None:
         logging.error("Program will now exit. Please update the configuration file and run the program again.")
@@ -42,8 +47,17 @@ async def main_func(comp_type):
             logging.warning(message)
             return
     
-    updater = InventoryUpdater(invent_path, config, comp_type)
-    await updater()
+    if keep_going:
+        config['continue_on_error'] = True
+    updater = InventoryUpdater(invent_path, config, comp_type, rescan, profiler)
+    try:
+        await updater()
+        if watch:
+            watcher = SurveyWatcher(updater, config.get('watch_interval', 5), config.get('watch_settle_seconds', 2),
+                                    config.get('watch_rescan_seconds', 3600))
+            await watcher.run()
+    finally:
+        await updater.close()
 
 def test_workflow():
     settings = load_config()
@@ -118,6 +132,27 @@ def test_workflow():
 
     test_module_workflow(selected_file, comp_type, config.get('ogp_tray_dir'))
 
+@contextmanager
+def profiling(out_dir, trace_memory=False):
+    """Profile the body of a with block (see `RunProfiler`) if out_dir is not None, and write the profiles to out_dir.
+    An empty out_dir writes them to a new directory under ~/.my-cli-tool/profiles.
+
+    Yield
+    - RunProfiler: The profiler, or None if not profiling."""
+    if out_dir is None:
+        yield None
+        return
+    if not out_dir:
+        out_dir = pjoin(os.path.dirname(SETTINGS_FILE), 'profiles', datetime.now().strftime('%Y%m%d-%H%M%S'))
+    profiler = RunProfiler(trace_memory)
+    try:
+        with profiler.stage('main', trace_memory=False):
+            yield profiler
+    finally:
+        profiler.write(out_dir)
+        profiler.print_summary(out_dir)
+        logging.warning(f"Profiles written to {out_dir}. View them with e.g. snakeviz run.pstats or flamegraph.pl run.collapsed")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description=program_descriptions,
@@ -125,12 +160,19 @@ if __name__ == "__main__":
         formatter_class=RichHelpFormatter
     )
 
-    parser.add_argument("--print", action='store_true', help="Print the current inventory.")
+    parser.add_argument("--print", action='store_true', help="Print the current inventory with the parse and upload status of each file. Use with --type to print a single component type.")
     parser.add_argument("--clear", action='store_true', help="Clear the current inventory. Note that these do not delete the OGP output files. They only remove the files from being marked as uploaded in the inventory.")
+    parser.add_argument("--index", action='store_true', help="Print the header fields (component ID, geometry, density, position, tray, run date) of all OGP survey files. Use with --type to index a single component type.")
+    parser.add_argument("--clearcache", action='store_true', help="Clear the cache of parsed OGP surveys. Surveys are then parsed again on the next upload.")
     parser.add_argument("--updatedb", action='store_true', help="Update the credentials in the configuration file.")
     parser.add_argument("--updatedir", action='store_true', help="Update the directory paths for OGP outputs/processing in the configuration file.")
     parser.add_argument("--type", type=str, default='', help="Specify the type of component to process and upload [baseplates/hexaboards/protomodules/modules]. If not specified, all components will be processed.")
+    parser.add_argument("--watch", action='store_true', help="Keep running and upload new surveys as soon as they are completely written. Use with --type to watch a single component type. Stop with Ctrl+C.")
+    parser.add_argument("--rescan", action='store_true', help="Check every survey file for changes, including surveys edited in place. Changed surveys are processed and uploaded again.")
+    parser.add_argument("--keep-going", action='store_true', help="Process every survey even if some fail, and retry uploads that failed because the database was unreachable. Failed surveys are retried on the next run.")
     parser.add_argument("--debug", action='store_true', help="Print debug messages.")
+    parser.add_argument("--profile", nargs='?', const='', default=None, metavar="DIR", help="Profile the run (also with --test) and write cProfile stats (.pstats) and flame graph stacks (.collapsed) for the whole run and for each stage (parse, compute, render, upload) to DIR, by default a new directory under ~/.my-cli-tool/profiles.")
+    parser.add_argument("--profile-memory", action='store_true', help="With --profile, also record the peak memory allocated in each stage (slower).")
     parser.add_argument("--disable", action='store_true', help="Disable the program from uploading.")
     parser.add_argument("--test", action='store_true', help="Run the program in test mode on a selected file.")
 
@@ -142,12 +184,19 @@ if __name__ == "__main__":
         setup_logging(logging.WARNING)
     
     if args.print:
-        invent_print()
+        invent_print(args.type)
         sys.exit(0)
     if args.clear:
         logging.info("Clearing the current inventory...")
         clear_invent()
         sys.exit(0)
+    if args.index:
+        index_print(args.type)
+        sys.exit(0)
+    if args.clearcache:
+        logging.info("Clearing the parse cache...")
+        clear_parse_cache()
+        sys.exit(0)
     if args.updatedb:
         logging.info("Updating credentials...")
         result = asyncio.run(update_credentials())
@@ -158,7 +207,14 @@ if __name__ == "__main__":
         sys.exit(0)
     if args.test:
         logging.info("Running in test mode...")
-        test_workflow()
+        with profiling(args.profile, args.profile_memory):
+            test_workflow()
         sys.exit(0)
 
-    asyncio.run(main_func(args.type))
+    try:
+        with profiling(args.profile, args.profile_memory) as profiler:
+            asyncio.run(main_func(args.type, args.watch, args.rescan, args.keep_going, profiler))
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        logging.warning("Stopped watching for new surveys.")
@@ -1,6 +1,15 @@
-import os, subprocess, json, sys, logging
-from .parse_data import DataParser, ParserKeyException
-from .process_survey import SurveyProcessor
+import os, subprocess, json, sys, logging, asyncio, time, socket
+from .parse_data import DataParser, ParserKeyException, FileFingerprint
+from .parse_cache import ParseCache
+from .header_scan import component_rank, order_by_run_time, scan_headers, COMPONENT_DEPENDENCIES
+from .process_survey import SurveyProcessor, SurveyOutcome, db_component_name, OK, PARSE_ERROR
+from .render_pool import RenderPool
+from .profiling import to_thread
+from .timing import RunTimer
+from .upload_inspect import DBClient, proto_name
+from .param import COMPONENT_PARAMS
+from .inventory_store import InventoryStore, UPLOADED, SKIPPED, FAILED
+from .survey_scan import scan_survey_dir
 from rich.table import Table
 from rich.console import Console
 
@@ -9,20 +18,52 @@ pjoin = os.path.join
 
 class InventoryUpdater():
     """Update the inventory of OGP results and upload new files to the database."""
-    def __init__(self, inventory_path, config_yaml, comp_type=''):
+    def __init__(self, inventory_path, config_yaml, comp_type='', rescan=False, profiler=None):
         """Initialize the file uploader.
         
         Parameters
-        - `inventory_path`: path to the inventory json file."""
+        - `inventory_path`: path to the inventory json file. The inventory is kept in a SQLite database next to it,
+        and an existing json inventory is imported on first use.
+        - `rescan`: list every survey subdirectory, also unchanged ones, to find surveys edited in place.
+        - `profiler`: RunProfiler profiling the parse, compute, render and upload stages, with `--profile`."""
         self.inventory_p = inventory_path
+        self.store = InventoryStore.open(inventory_path)
         self.config = config_yaml
         self.checkdir = self.config.get('ogp_survey_dir')
         self.parsed_dir = self.config.get('ogp_parsed_dir')
         self.comp_type = comp_type
-        logging.debug(f"Reading inventory from: {self.inventory_p}")
+        self.rescan = rescan
+        # several uploaders may share the inventory; files are claimed by one of them at a time
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.claim_lease = self.config.get('claim_lease_seconds', 1800)
+        self.parse_workers = self.config.get('parse_workers', 1)
+        self.parse_cache = self.get_parse_cache(self.config)
+        self.parsed_format = self.config.get('parsed_format', 'npz')
+        self.save_parsed = self.config.get('save_parsed', True)
+        self.profiler = profiler
+        self.render_pool = RenderPool(self.config.get('render_workers', 2), profiler)
+        self.client = DBClient(self.config)  # one connection pool for all component types
+        self.component_workers = max(1, self.config.get('component_workers', 2))
+        self.proto_offsets = {}  # offsets of the protomodules uploaded in this run, used by their modules
+        self.timer = RunTimer(self.config.get('run_report_max_entries', 10000))
+        logging.debug(f"Reading inventory from: {self.store.db_path}")
         logging.debug(f"Parsing OGP survey files from directory: {self.checkdir}")
         logging.debug(f"Saving parsed data to directory: {self.parsed_dir}")
 
+    @staticmethod
+    def get_parse_cache(config):
+        """Return the parse cache under `ogp_parsed_dir`, or None if disabled with `parse_cache_size: 0`."""
+        cache_size = config.get('parse_cache_size', 5000)
+        if not cache_size or not config.get('ogp_parsed_dir'):
+            return None
+        return ParseCache(pjoin(config['ogp_parsed_dir'], '.cache'), cache_size)
+
+    async def close(self):
+        """Stop the render worker processes, close the database connections and the inventory."""
+        self.render_pool.close()
+        await self.client.close()
+        self.store.close()
+
     def display_file_changes(self, new_inventory, removed_inventory, successful_uploads):
         """Display a table of file changes using rich.Table"""
         console = Console()
@@ -67,14 +108,11 @@ class InventoryUpdater():
         console.print("\n")
     
     async def __call__(self):
-        if not pexist(self.inventory_p):
-            self.__deal_empty()
+        if self.store.get_meta('initialized') is None:
+            await self.__deal_empty()
             return
-            
-        with open(self.inventory_p, 'r') as f:
-            self.inventory = json.load(f)
         
-        new_files, removed_files = self.__check_inventory()
+        new_files, removed_files = await self.__check_inventory()
         self.__update_removed(removed_files)
         status = await self.upload_and_update(new_files)
         
@@ -84,131 +122,102 @@ class InventoryUpdater():
             logging.error("Some files failed to upload to the database.\n")
 
     def __update_removed(self, removed_invent):
-        for subdir, files in removed_invent.items():
-            if subdir in self.inventory:
-                self.inventory[subdir] = [file for file in self.inventory[subdir] if file not in files]
-                if not self.inventory[subdir]:
-                    del self.inventory[subdir]
-        
-        with open(self.inventory_p, 'w') as f:
-            json.dump(self.inventory, f)
+        """Report files removed from the survey directory. The scan already dropped them from the inventory."""
+        if not removed_invent:
+            return
         
         logging.warning("\n=== Inventory Update Alert ===")
         logging.warning(f"Removed {sum(len(files) for files in removed_invent.values())} files from inventory")
 
-    def __update_inven(self, success_invent):
-        """Update the inventory with the successfully uploaded files."""
-        for subdir, files in success_invent.items():
-            if subdir not in self.inventory:
-                self.inventory[subdir] = files
-            else:
-                self.inventory[subdir].extend(files)
-                self.inventory[subdir] = list(dict.fromkeys(self.inventory[subdir]))
-        
-        with open(self.inventory_p, 'w') as f:
-            json.dump(self.inventory, f)
-        
-        logging.info("\n=== Inventory Update Alert ===")
-        logging.info(f"Successfully updated inventory with {sum(len(files) for files in success_invent.values())} new files")
+    def __update_inven(self, subdir, inputs, surveys, outcomes, parse_seconds, upload_seconds) -> list:
+        """Record the parse and upload results of one batch of files in the inventory, in one transaction.
+        Only files that were uploaded are marked as such; failed files keep the reason of their failure.
 
-    def __create_new(self) -> dict:
-        """Create a new inventory dictionary. 
-        With structure like {subdir:[files]} 
+        Parameters
+        - `inputs`: paths of the survey files in the batch.
+        - `surveys`: `ParsedSurvey`s that passed parsing, in upload order.
+        - `outcomes`: {survey file path: SurveyOutcome} of the files that were processed. Files without an outcome
+        were not attempted after an earlier failure and stay pending.
+        - `parse_seconds`, `upload_seconds`: {survey file path: seconds} spent parsing and processing/uploading it.
         
         Return
-        - dictionary of subdirectories and their corresponding txt files."""
-        txt_files_by_subdir = {}
-        for item in os.listdir(self.checkdir):
-            subdir_path = pjoin(self.checkdir, item)
-            if os.path.isdir(subdir_path):
-                txt_files = [
-                    file for file in os.listdir(subdir_path)
-                    if file.endswith('.txt') and not file.startswith('.')
-                ]
-                
-                if txt_files:
-                    txt_files_by_subdir[item] = txt_files
-
-        return txt_files_by_subdir
-    
+        - list of the uploaded filenames."""
+        parsed = {survey.source: survey.fingerprint for survey in surveys}
+        uploaded = {path for path, outcome in outcomes.items() if outcome.status == OK}
+        rows = {}
+        for path in inputs:
+            # fingerprint of the contents that were parsed, not of the file on disk now, which may have been edited since
+            fingerprint = parsed.get(path)
+            if fingerprint is None:
+                try:
+                    stat = os.stat(path)
+                    fingerprint = FileFingerprint(stat.st_size, stat.st_mtime, None)
+                except OSError:
+                    fingerprint = FileFingerprint(None, None, None)
+            size, mtime = fingerprint.size, fingerprint.mtime
+            outcome = outcomes.get(path)
+            if outcome is None:
+                upload_status = None  # not attempted after an earlier failure
+            else:
+                upload_status = UPLOADED if outcome.status == OK else FAILED
+            # the hash tells later edits from touches of uploaded files
+            digest = fingerprint.hash if path in uploaded else None
+            rows[os.path.basename(path)] = {
+                'size': size, 'mtime': mtime, 'hash': digest,
+                'parse_status': 'parsed' if path in parsed else FAILED,
+                'upload_status': upload_status,
+                'parse_seconds': parse_seconds.get(path),
+                'upload_seconds': upload_seconds.get(path),
+                'error': f"{outcome.status}: {outcome.reason}" if upload_status == FAILED else None}
+        self.store.record_files(subdir, rows)
+        uploaded_files = [os.path.basename(path) for path in inputs if path in uploaded]
+
+        logging.info("\n=== Inventory Update Alert ===")
+        logging.info(f"Successfully updated inventory with {len(uploaded_files)} new files")
+        return uploaded_files
+
     async def __deal_empty(self) -> bool:
         """Check if inventory is empty and prompt user to upload all existing OGP results to database.
         
         Return 
         - bool: whether all existing OGP results are uploaded to database."""
-        txt_files_by_subdir = self.__create_new()
-
-        with open(self.inventory_p, 'w') as f:
-            json.dump(txt_files_by_subdir, f)
+        txt_files_by_subdir, _, _ = await scan_survey_dir(self.checkdir, self.store, force=True)
+        self.store.set_meta('initialized', str(time.time()))
 
         logging.info("Initialize Inventory of OGP results for the first time...Would you like to process and upload all the existing OGP results to database? (Y/N)")
         choice = input().strip().lower()
 
         if choice == 'y':
             logging.info("Uploading all existing OGP results to database...")
-            await self.upload_files(txt_files_by_subdir)
-            return True
+            return await self.upload_and_update(txt_files_by_subdir)
         else:
+            # Existing results are marked as known, so that only new surveys are uploaded from now on
+            for subdir, files in txt_files_by_subdir.items():
+                self.store.record_many(subdir, files, upload_status=SKIPPED)
             logging.info("Exiting...")
             return False
     
-    def __check_inventory(self) -> tuple[dict, dict]:
+    async def __check_inventory(self) -> tuple[dict, dict]:
         """Check for changes in the inventory of OGP results.
         If self.comp_type is specified, only check that specific subdirectory.
+        Only subdirectories modified since the last run are listed (see `scan_survey_dir`).
 
         Returns:
-        - dict: Subdirectories and their corresponding new files to be processed.
+        - dict: Subdirectories and their corresponding files to be processed: new files, and files that failed before.
         - dict: Subdirectories and their corresponding removed files.
         """
         logging.info("\n=== Checking for OGP Survey File Changes ===")
-        new_inventory = self.__create_new()
-        old_inventory = self.inventory.copy()
-        changed_inventory = {}
-        removed_inventory = {}
-
-        total_new_files = 0
-        total_removed_files = 0
-        new_subdirs = []
-
-        if self.comp_type:
-            if self.comp_type in new_inventory:
-                new_inventory = {self.comp_type: new_inventory[self.comp_type]}
-            else:
-                new_inventory = {}
-                logging.info("No new files to process for component type:", self.comp_type)
-                sys.exit()
-            if self.comp_type in old_inventory:
-                old_inventory = {self.comp_type: old_inventory[self.comp_type]}
-            else:
-                old_inventory = {}
+        if self.comp_type and not os.path.isdir(pjoin(self.checkdir, self.comp_type)):
+            logging.info(f"No new files to process for component type: {self.comp_type}")
+            return {}, {}
 
-        for subdir, files in new_inventory.items():
-            if subdir not in old_inventory:
-                new_subdirs.append(subdir)
-                changed_inventory[subdir] = files
-                total_new_files += len(files)
-            else:
-                new_files = set(files) - set(old_inventory[subdir])
-                removed_files = set(old_inventory[subdir]) - set(files)
-                if new_files or removed_files:
-                    logging.info(f"\nChanges in subdirectory '{subdir}':")
-                    if new_files:
-                        logging.info(f"  + Added: {', '.join(sorted(new_files))}")
-                        total_new_files += len(new_files)
-                    if removed_files:
-                        logging.info(f"  - Removed: {', '.join(sorted(removed_files))}")
-                        total_removed_files += len(removed_files)
-
-                if new_files:
-                    changed_inventory[subdir] = list(new_files)
-                if removed_files:
-                    removed_inventory[subdir] = list(removed_files)
-        
-        # check for removed subdirectories
-        for subdir in old_inventory:
-            if subdir not in new_inventory:
-                removed_inventory[subdir] = old_inventory[subdir]
-                total_removed_files += len(old_inventory[subdir])
+        added, modified, removed_inventory = await scan_survey_dir(self.checkdir, self.store, self.comp_type, force=self.rescan)
+        changed_inventory = self.store.pending(self.comp_type)
+
+        total_new_files = sum(len(files) for files in added.values()) + sum(len(files) for files in modified.values())
+        total_retried = sum(len(files) for files in changed_inventory.values()) - total_new_files
+        if total_retried:
+            logging.info(f"Retrying {total_retried} files that were not uploaded before.")
 
         return changed_inventory, removed_inventory
     
@@ -221,42 +230,179 @@ class InventoryUpdater():
         Returns
         - `bool`: True if all files were successfully processed & uploaded, False otherwise.
         """
-        status = True 
-        for subdir, files in invent.items():
-            inputs = [pjoin(self.checkdir, subdir, file) for file in files]
-            if inputs:
-                parse_output_dir = pjoin(self.parsed_dir, subdir)
-                dp = DataParser(inputs, parse_output_dir)
-                try: 
-                    gen_meta, gen_features = dp()
-                except ParserKeyException as e:
-                    sys.exit()
-                uploader = SurveyProcessor(gen_features, gen_meta, self.config)
-                success, indx = await uploader(subdir)
-
-                successful_uploads = {}
-                if success:
-                    successful_uploads[subdir] = files
-                elif indx != -1:
-                    successful_files = files[:indx+1]
-                    if successful_files:  # Only add if there were successful uploads
-                        successful_uploads[subdir] = successful_files
-                    logging.warning(f"Failed to upload file: {inputs[indx + 1]}")
-                    status = False
-                else:
-                    status = False
-                    logging.warning(f"Failed to upload files from {subdir}")
-                
-                if successful_uploads: 
-                    logging.info("These files were successfully uploaded:", successful_uploads)
-                    self.__update_inven(successful_uploads)
-            else:
-                logging.warning(f"No files from {subdir} to process/upload to database.")
+        pending_writes = []
+        successful_uploads = {}
+        limit = asyncio.Semaphore(self.component_workers)
+        tasks = {}
+
+        async def run_component(subdir, files):
+            # e.g. modules wait until the protomodules of this batch, whose offsets they need, are uploaded
+            for dependency in COMPONENT_DEPENDENCIES.get(subdir, []):
+                if dependency in tasks:
+                    await asyncio.wait([tasks[dependency]])
+            async with limit:
+                return await self.upload_component(subdir, files, pending_writes, headers)
+
+        self.client.sensor_offsets.clear()  # protomodule offsets are fetched once per run
+        # the headers of the batch are read once, for the mother table lookups, the run order and the protomodule offsets
+        paths = [pjoin(self.checkdir, subdir, file) for subdir, files in invent.items() for file in files]
+        headers = {header.path: header for header in await to_thread(self.profiler, scan_headers, paths)} if paths else {}
+        await self.prefetch_mother_entries(headers.values())
+        try:
+            # component types run concurrently, at most component_workers at a time, started in dependency order
+            for subdir, files in sorted(invent.items(), key=lambda item: component_rank(item[0])):
+                tasks[subdir] = asyncio.create_task(run_component(subdir, files))
+            results = await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            self.store.release(self.owner)
+
+        status = all(success for success, _ in results)
+        for subdir, (_, uploaded_files) in zip(tasks, results):
+            if uploaded_files:
+                successful_uploads[subdir] = uploaded_files
             
         if invent:
             self.display_file_changes(invent, {}, successful_uploads)
+            self.report_timings()
+
+        for result in await asyncio.gather(*pending_writes, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.warning(f"Failed to save parsed survey outputs: {result}")
         
         return status
+
+    async def prefetch_mother_entries(self, headers):
+        """Look up the components of all files to upload in their mother tables with one query, from their `SurveyHeader`s.
+        The uploads then take the mother table entries from the cache of the database client."""
+        names = {}
+        for header in headers:
+            names.setdefault(header.comp_type.rstrip('s'), []).append(db_component_name(header.comp_type, header.ComponentID))
+        if not names:
+            return
+        try:
+            await self.client.prefetch_mother_entries({comp_type: names[comp_type] for comp_type in names if comp_type in COMPONENT_PARAMS})
+        except Exception as e:  # the uploads check the mother tables themselves
+            logging.debug(f"Could not look up the mother table entries of the batch: {e}")
+
+    async def prefetch_sensor_offsets(self, headers):
+        """Fetch the offsets of the protomodules of the module surveys with these `SurveyHeader`s with one query.
+        Protomodules uploaded in this run are taken from `proto_offsets` instead."""
+        try:
+            names = [header.ComponentID for header in headers
+                     if header.ComponentID and proto_name(header.ComponentID).upper() not in self.proto_offsets]
+            if not names:
+                return
+            offsets = await self.client.GrabSensorOffsetsBatch(names)
+            logging.debug(f"Fetched the protomodule offsets of {sum(value is not None for value in offsets.values())} of {len(names)} modules.")
+        except Exception as e:  # the modules query their protomodules one by one
+            logging.debug(f"Could not fetch the protomodule offsets of the modules: {e}")
+
+    def report_timings(self):
+        """Print the stage timings of this run and write them to run_report.json/.csv next to the inventory.
+        In watch mode the report covers every batch since the start, up to the latest `run_report_max_entries` attempts."""
+        if not self.timer.timings or not self.config.get('run_report', True):
+            return
+        self.timer.print_summary()
+        try:
+            json_path, csv_path = self.timer.write_report(os.path.dirname(os.path.abspath(self.inventory_p)))
+            logging.info(f"Run report written to {json_path} and {csv_path}")
+        except OSError as e:
+            logging.warning(f"Could not write the run report: {e}")
+
+    async def upload_component(self, subdir, files, pending_writes, headers=None) -> tuple[bool, list]:
+        """Claim, parse, postprocess and upload the files of one component type.
+        Files claimed by another uploader process are left to it.
+
+        Parameters
+        - `subdir`: component type, e.g. modules.
+        - `files`: survey filenames in `ogp_survey_dir/subdir`.
+        - `pending_writes`: list collecting the background tasks writing parsed outputs.
+        - `headers`: {path: SurveyHeader} of the batch, scanned by `upload_and_update`. The files are scanned if not given.
+
+        Returns
+        - `bool`: True if all claimed files were successfully processed & uploaded, False otherwise.
+        - `list`: filenames that were uploaded."""
+        await self.wait_for_dependencies(subdir)
+        claimed = self.store.claim(subdir, files, self.owner, self.claim_lease)
+        if len(claimed) < len(files):
+            logging.info(f"Skipping {len(files) - len(claimed)} files from {subdir} that another uploader is processing.")
+        paths = [pjoin(self.checkdir, subdir, file) for file in claimed]
+        if headers is None:
+            headers = {header.path: header for header in await to_thread(self.profiler, scan_headers, paths)}
+        inputs = order_by_run_time(paths, headers)
+        if not inputs:
+            logging.warning(f"No files from {subdir} to process/upload to database.")
+            return True, []
+
+        if subdir == 'modules':
+            await self.prefetch_sensor_offsets([headers[path] for path in inputs if path in headers])
+        parse_output_dir = pjoin(self.parsed_dir, subdir)
+        dp = DataParser(inputs, parse_output_dir, workers=self.parse_workers, cache=self.parse_cache, output_format=self.parsed_format)
+        surveys, parse_seconds = [], {}
+        def parsed():
+            # consumed by the processing pipeline, so that parsing overlaps processing and uploading
+            start = time.perf_counter()
+            surveys_iter = dp.iter_surveys()
+            if self.profiler is not None:
+                surveys_iter = self.profiler.iterate('parse', surveys_iter)
+            for survey in surveys_iter:
+                now = time.perf_counter()
+                parse_seconds[survey.source] = now - start
+                self.timer.start(survey.source)
+                self.timer.add(survey.source, 'parse', now - start)
+                surveys.append(survey)
+                yield survey
+                start = time.perf_counter()
+        parse_iter = parsed()
+        uploader = SurveyProcessor([], [], self.config, surveys=parse_iter, render_pool=self.render_pool.start(), proto_offsets=self.proto_offsets,
+                                   timer=self.timer, profiler=self.profiler, client=self.client)
+        try: 
+            success, _ = await uploader(subdir)
+            # the pipeline stops early on a failure; the remaining files are still parsed and recorded
+            await to_thread(self.profiler, list, parse_iter)
+        except ParserKeyException as e:
+            sys.exit()
+        if self.parse_cache is not None:
+            self.parse_cache.evict()
+        if self.save_parsed:
+            # Parsed outputs are only kept for reference, so write them in the background
+            pending_writes.append(asyncio.create_task(
+                to_thread(self.profiler, self.write_parsed, surveys, parse_output_dir, self.parsed_format)))
+
+        outcomes = dict(uploader.outcomes)
+        for path in inputs:
+            if path in dp.parse_errors:
+                outcomes[path] = SurveyOutcome(path, PARSE_ERROR, dp.parse_errors[path])
+        failures = [outcome for outcome in outcomes.values() if outcome.status != OK]
+        for outcome in failures:
+            logging.warning(f"Failed to upload file: {outcome.source} ({outcome.status}: {outcome.reason})")
+        success = success and not failures
+        
+        uploaded_files = self.__update_inven(subdir, inputs, surveys, outcomes, parse_seconds, uploader.timings)
+        self.store.release(self.owner, subdir, claimed)
+        if uploaded_files:
+            logging.info(f"These files were successfully uploaded: {uploaded_files}")
+        return success, uploaded_files
+
+    async def wait_for_dependencies(self, subdir, poll_interval=2.0):
+        """Wait while another uploader is processing component types that subdir depends on (see `COMPONENT_DEPENDENCIES`),
+        e.g. protomodules whose offsets the modules need."""
+        for dependency in COMPONENT_DEPENDENCIES.get(subdir, []):
+            announced = False
+            while self.store.claimed_by_others(dependency, self.owner):
+                if not announced:
+                    logging.info(f"Waiting for another uploader to finish {dependency} before processing {subdir}...")
+                    announced = True
+                await asyncio.sleep(poll_interval)
+
+    @staticmethod
+    def write_parsed(surveys, output_dir, output_format):
+        """Write parsed surveys to output_dir. Runs in a worker thread."""
+        for survey in surveys:
+            survey.write(output_dir, output_format)
         
     def run_on_new_files(self, files, action):
         """Run the action on each file in the list of files
@@ -187,6 +187,28 @@ def get_default_config():
         'ogp_parsed_dir': '/path/to/ogp/parsed/directory',
         'ogp_tray_dir': '/path/to/ogp/tray/directory',
         'ogp_image_dir': '/path/to/ogp/image/directory',
+        'parse_workers': 1,
+        'parse_cache_size': 5000,
+        'parsed_format': 'npz',
+        'save_parsed': True,
+        'watch_interval': 5,
+        'watch_settle_seconds': 2,
+        'watch_rescan_seconds': 3600,
+        'claim_lease_seconds': 1800,
+        'db_pool_min_size': 1,
+        'db_pool_max_size': 4,
+        'mother_cache_seconds': 300,
+        'component_workers': 2,
+        'compute_workers': 1,
+        'render_workers': 2,
+        'upload_workers': 1,
+        'upload_batch_size': 50,
+        'pipeline_queue_size': 2,
+        'continue_on_error': False,
+        'upload_retries': 3,
+        'retry_backoff_seconds': 2,
+        'run_report': True,
+        'run_report_max_entries': 10000,
     }
 
 def verify_config(current_config):
@@ -0,0 +1,86 @@
+import os, time, asyncio
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+class FileLock():
+    """Advisory lock on a file, shared between processes (fcntl.flock on POSIX, msvcrt.locking on Windows).
+    Use as a context manager, or as an async one in coroutines, which waits without blocking the event loop.
+    The lock is released when the block exits or the process dies.
+    Only reliable between processes of one machine: network file systems (NFS, SMB) may not honour it."""
+    def __init__(self, path, timeout=None, poll_interval=0.1):
+        """Parameters:
+        - path (str): Lock file, created if missing. Its contents are not used.
+        - timeout (float): Seconds to wait for the lock before raising TimeoutError. None waits forever."""
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def _try_lock(self, fd) -> bool:
+        try:
+            if os.name == 'nt':
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        return fd, deadline
+
+    def _check_deadline(self, fd, deadline):
+        if deadline is not None and time.monotonic() >= deadline:
+            os.close(fd)
+            raise TimeoutError(f"Timed out waiting for lock {self.path}")
+
+    def acquire(self):
+        fd, deadline = self._open()
+        while not self._try_lock(fd):
+            self._check_deadline(fd, deadline)
+            time.sleep(self.poll_interval)
+        self._fd = fd
+
+    async def acquire_async(self):
+        """`acquire` for coroutines: polls with asyncio.sleep, so the event loop keeps running while it waits."""
+        fd, deadline = self._open()
+        try:
+            while not self._try_lock(fd):
+                self._check_deadline(fd, deadline)
+                await asyncio.sleep(self.poll_interval)
+        except asyncio.CancelledError:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if os.name == 'nt':
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
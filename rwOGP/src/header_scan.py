@@ -0,0 +1,145 @@
+import os, logging
+from datetime import datetime
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+from src.parse_data import preprocess_survey_line, parse_header_lines
+from src.parser_template import header_template_bp_hxb
+
+pjoin = os.path.join
+
+# Order in which component types depend on each other: modules need protomodule offsets
+COMPONENT_ORDER = ['baseplates', 'hexaboards', 'protomodules', 'modules']
+# Component types whose uploads must be finished before a component type is processed
+COMPONENT_DEPENDENCIES = {'modules': ['protomodules']}
+
+class SurveyHeader(NamedTuple):
+    """Header fields of one survey file, as read by `scan_header`. Missing fields are None."""
+    path: str
+    ComponentID: str
+    Operator: str
+    Geometry: str
+    Density: str
+    PositionID: int
+    TrayNo: str
+    RunDate: str
+    RunTime: str
+    ProjectName: str
+
+    @property
+    def comp_type(self) -> str:
+        """Component folder name (e.g. modules) the survey file lives in."""
+        return os.path.basename(os.path.dirname(self.path))
+
+    @property
+    def run_datetime(self):
+        """Date and time of the survey run, or None if missing or malformed."""
+        try:
+            return datetime.strptime(f"{self.RunDate} {self.RunTime}", '%m:%d:%y %H:%M:%S')
+        except (TypeError, ValueError):
+            return None
+
+def _clean(value):
+    return None if value in (None, '""') else value
+
+def read_header_text(path, delimiter='---', block_size=4096, max_bytes=1 << 16) -> str:
+    """Read a survey file only up to the header delimiter line.
+
+    Return
+    - text (str): Everything before the delimiter, or the first max_bytes if no delimiter was found."""
+    marker = delimiter.encode()
+    data = b''
+    checked = 0  # data[:checked] holds complete lines that are not the delimiter
+    with open(path, 'rb') as f:
+        while len(data) < max_bytes:
+            block = f.read(block_size)
+            data += block
+            # only look at complete lines, unless the file has ended
+            end = len(data) if not block else data.rfind(b'\n') + 1
+            while checked < end:
+                line_end = data.find(b'\n', checked, end)
+                line_end = end if line_end == -1 else line_end + 1
+                if data[checked:line_end].strip() == marker:
+                    return data[:checked].decode('utf-8', errors='replace')
+                checked = line_end
+            if not block:
+                break
+    return data.decode('utf-8', errors='replace')
+
+def scan_header(path, delimiter='---', header_template=header_template_bp_hxb) -> SurveyHeader:
+    """Read only the header of a survey file and return its typed header record."""
+    lines = (preprocess_survey_line(line) for line in read_header_text(path, delimiter).splitlines())
+    header = parse_header_lines([line for line in lines if line is not None], header_template)
+
+    position = _clean(header.get('PositionID'))
+    try:
+        position = int(position) if position is not None else None
+    except ValueError:
+        logging.warning(f"PositionID '{position}' in {path} is not an integer.")
+        position = None
+    geometry = _clean(header.get('Geometry'))
+    density = _clean(header.get('Density'))
+    return SurveyHeader(
+        path=path,
+        ComponentID=_clean(header.get('ComponentID')),
+        Operator=_clean(header.get('Operator')),
+        Geometry=geometry.capitalize() if geometry else geometry,
+        Density=density.upper() if density else density,
+        PositionID=position,
+        TrayNo=_clean(header.get('TrayNo')),
+        RunDate=_clean(header.get('RunDate')),
+        RunTime=_clean(header.get('RunTime')),
+        ProjectName=_clean(header.get('ProjectName')),
+    )
+
+def _try_scan(path):
+    try:
+        return scan_header(path)
+    except OSError as e:
+        logging.warning(f"Could not read header of {path}: {e}")
+        return None
+
+def scan_headers(paths, workers=8) -> list:
+    """Scan the headers of many survey files, using threads to overlap file reads.
+    Return the `SurveyHeader`s in the order of paths, skipping unreadable files."""
+    paths = list(paths)
+    if workers <= 1 or len(paths) <= 1:
+        headers = map(_try_scan, paths)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            headers = list(executor.map(_try_scan, paths))
+    return [header for header in headers if header is not None]
+
+def index_survey_dir(survey_dir, comp_types=None, workers=8) -> list:
+    """Index the headers of all survey files under survey_dir/<component type>/.
+
+    Parameters:
+    - survey_dir (str): The `ogp_survey_dir` directory.
+    - comp_types (list): Component folders to index. All subdirectories if None.
+
+    Return
+    - list of `SurveyHeader`, grouped by component type in `COMPONENT_ORDER`."""
+    paths = []
+    with os.scandir(survey_dir) as subdirs:
+        for subdir in sorted(subdirs, key=lambda entry: component_rank(entry.name)):
+            if not subdir.is_dir() or (comp_types and subdir.name not in comp_types):
+                continue
+            with os.scandir(subdir.path) as files:
+                paths.extend(sorted(entry.path for entry in files
+                                    if entry.is_file() and entry.name.endswith('.txt') and not entry.name.startswith('.')))
+    return scan_headers(paths, workers)
+
+def component_rank(comp_type) -> tuple:
+    """Sort key placing component types in dependency order (`COMPONENT_ORDER`), unknown types last."""
+    if comp_type in COMPONENT_ORDER:
+        return (COMPONENT_ORDER.index(comp_type), comp_type)
+    return (len(COMPONENT_ORDER), comp_type)
+
+def order_by_run_time(paths, headers=None) -> list:
+    """Order survey files by the run date/time in their headers (oldest first). Files without one keep their order at the end.
+    headers ({path: SurveyHeader}) are the already scanned headers of the files; they are scanned if not given."""
+    if headers is None:
+        headers = {header.path: header for header in scan_headers(paths)}
+    headers = {path: headers[path].run_datetime for path in paths if path in headers}
+    indexed = list(enumerate(paths))
+    indexed.sort(key=lambda item: (headers.get(item[1]) is None, headers.get(item[1]) or datetime.min, item[0]))
+    return [path for _, path in indexed]
@@ -1,45 +1,93 @@
 from src.config_utils import load_config
 from src.auto_upload import InventoryUpdater
-import json, sys, logging
+from src.header_scan import index_survey_dir
+from src.inventory_store import InventoryStore
+from rich.console import Console
+from rich.table import Table
+import os, json, sys, logging, yaml
+from datetime import datetime
 
-def invent_print():
-    """Print the current inventory."""
+def invent_print(comp_type=''):
+    """Print the current inventory, optionally only for one component type."""
     settings = load_config()
     if settings is None:
         logging.warning("No configuration file found. Program will now exit. Please run without arguments first!")
     else:
-        invent_path = settings['inventory_path']
-        print(f"Printing the current inventory {invent_path}...")
-        inventory = InventoryUpdater.deal_corrupt(invent_path)
-        print(inventory)
+        with InventoryStore.open(settings['inventory_path']) as store:
+            print(f"Printing the current inventory {store.db_path}...")
+            rows = store.rows(comp_type)
+        table = Table(title=f"OGP Survey Inventory ({len(rows)} files)", show_header=True, header_style="bold blue")
+        for column in ["Type", "File", "Size", "Modified", "Parse", "Upload", "Parse (s)", "Upload (s)", "Error"]:
+            table.add_column(column)
+        for row in rows:
+            table.add_row(row['comp_type'], row['filename'],
+                          str(row['size']) if row['size'] is not None else '-',
+                          datetime.fromtimestamp(row['mtime']).strftime('%Y-%m-%d %H:%M:%S') if row['mtime'] else '-',
+                          row['parse_status'] or '-', row['upload_status'] or '-',
+                          f"{row['parse_seconds']:.2f}" if row['parse_seconds'] is not None else '-',
+                          f"{row['upload_seconds']:.2f}" if row['upload_seconds'] is not None else '-',
+                          row['error'] or '')
+        Console().print(table)
 
 def clear_invent():
-    """Clear the current inventory file."""
+    """Remove files from the current inventory, so that they are processed and uploaded again."""
     settings = load_config()
     if settings is None:
         logging.error("Program will now exit. Please run without arguments first!")
     else:
-        invent_path = settings['inventory_path']
-        inventory = InventoryUpdater.deal_corrupt(invent_path)
-        userinput = input("Enter the component type you want to clear: (e.g. baseplates) \n")
-        if userinput not in inventory:
-            logging.error("Component type not found in inventory.")
-            logging.error(f"The current component types are: {inventory.keys()}")
-            sys.exit(1)
-        else:
-            if_entire = input(f"Would you want to clear the entire inventory for this component type? (y/n) \n")
-            if if_entire == 'y':
-                logging.info(f"Clearing the current inventory {invent_path}...")
-                inventory[userinput] = []
+        with InventoryStore.open(settings['inventory_path']) as store:
+            comp_types = store.comp_types()
+            userinput = input("Enter the component type you want to clear: (e.g. baseplates) \n")
+            if userinput not in comp_types:
+                logging.error("Component type not found in inventory.")
+                logging.error(f"The current component types are: {comp_types}")
+                sys.exit(1)
             else:
-                filenames = input(f"Please enter specific filenames to clear from the inventory for {userinput}: (e.g. file1, file2, ...)\n")
-                filenames = filenames.split(',')
-                for filename in filenames:
-                    if filename in inventory[userinput]:
-                        inventory[userinput].remove(filename)
-                    else:
-                        logging.warning(f"Filename {filename} not found in inventory for {userinput}.")
+                if_entire = input(f"Would you want to clear the entire inventory for this component type? (y/n) \n")
+                if if_entire == 'y':
+                    logging.info(f"Clearing the current inventory {store.db_path}...")
+                    store.remove(userinput)
+                else:
+                    filenames = input(f"Please enter specific filenames to clear from the inventory for {userinput}: (e.g. file1, file2, ...)\n")
+                    filenames = [filename.strip() for filename in filenames.split(',')]
+                    for filename in filenames:
+                        if not store.remove(userinput, [filename]):
+                            logging.warning(f"Filename {filename} not found in inventory for {userinput}.")
         
-        with open(invent_path, 'w') as f:
-            json.dump(inventory, f)
-        logging.info(f"Inventory for {userinput} cleared.")
\ No newline at end of file
+        logging.info(f"Inventory for {userinput} cleared.")
+
+def clear_parse_cache():
+    """Remove all cached parse results."""
+    settings = load_config()
+    if settings is None:
+        logging.error("Program will now exit. Please run without arguments first!")
+        return
+    with open(settings['config_path'], 'r') as f:
+        config = yaml.safe_load(f)
+    cache = InventoryUpdater.get_parse_cache(config)
+    if cache is None:
+        logging.warning("Parse cache is disabled in the configuration file.")
+        return
+    removed = cache.clear()
+    logging.info(f"Removed {removed} entries from the parse cache {cache.cache_dir}.")
+
+def index_print(comp_type=''):
+    """Print an index of the headers of all survey files in the survey directory."""
+    settings = load_config()
+    if settings is None:
+        logging.error("Program will now exit. Please run without arguments first!")
+        return
+    with open(settings['config_path'], 'r') as f:
+        config = yaml.safe_load(f)
+    headers = index_survey_dir(config['ogp_survey_dir'], [comp_type] if comp_type else None)
+
+    table = Table(title=f"OGP Survey Index ({len(headers)} files)", show_header=True, header_style="bold blue")
+    for column in ["Type", "Component ID", "Geometry", "Density", "Position", "Tray", "Run Date", "Operator", "File"]:
+        table.add_column(column)
+    for header in headers:
+        run_datetime = header.run_datetime
+        table.add_row(header.comp_type, str(header.ComponentID), str(header.Geometry), str(header.Density),
+                      str(header.PositionID), str(header.TrayNo),
+                      run_datetime.strftime('%Y-%m-%d %H:%M:%S') if run_datetime else '-',
+                      str(header.Operator), os.path.basename(header.path))
+    Console().print(table)
@@ -0,0 +1,280 @@
+import os, json, sqlite3, time, logging
+from .file_lock import FileLock
+
+# Upload states of a survey file. Files in TRACKED_STATES are not processed again.
+UPLOADED, SKIPPED, FAILED = 'uploaded', 'skipped', 'failed'
+TRACKED_STATES = (UPLOADED, SKIPPED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    comp_type TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    parse_status TEXT,
+    upload_status TEXT,
+    parse_seconds REAL,
+    upload_seconds REAL,
+    error TEXT,
+    updated_at REAL,
+    claimed_by TEXT,
+    lease_until REAL,
+    PRIMARY KEY (comp_type, filename)
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (comp_type, upload_status);
+CREATE TABLE IF NOT EXISTS dirs (
+    comp_type TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+FILE_FIELDS = ('size', 'mtime', 'hash', 'parse_status', 'upload_status', 'parse_seconds', 'upload_seconds', 'error')
+
+class InventoryStore():
+    """Inventory of OGP survey files in a local SQLite database, with one row per file.
+    Rows are updated in small transactions, instead of rewriting the whole inventory for every batch.
+    Several processes on the same machine may share the database. It uses SQLite's WAL journal and `FileLock`,
+    neither of which works on network file systems, so it must be on a local disk."""
+    def __init__(self, db_path):
+        """Open (and create if needed) the inventory database.
+
+        Parameters:
+        - db_path (str): Path to the SQLite database file."""
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+            # columns added after the first version of the schema
+            columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(files)")}
+            for column, sql_type in (('claimed_by', 'TEXT'), ('lease_until', 'REAL'), ('error', 'TEXT')):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE files ADD COLUMN {column} {sql_type}")
+
+    @staticmethod
+    def db_path_for(inventory_path) -> str:
+        """Path of the database that replaces the inventory json file at inventory_path."""
+        return os.path.splitext(inventory_path)[0] + '.db'
+
+    @classmethod
+    def open(cls, inventory_path):
+        """Open the store next to inventory_path, importing the json inventory the first time."""
+        store = cls(cls.db_path_for(inventory_path))
+        if os.path.exists(inventory_path) and store.get_meta('initialized') is None:
+            with store.lock():
+                if store.get_meta('initialized') is None:
+                    store.migrate_json(inventory_path)
+        return store
+
+    def lock(self, timeout=None) -> FileLock:
+        """Advisory lock serializing read-modify-write steps (e.g. directory scans) between uploader processes."""
+        return FileLock(self.db_path + '.lock', timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def migrate_json(self, json_path) -> int:
+        """Import the files listed in a json inventory ({comp_type: [files]}) as uploaded.
+        The json file is left in place. Return the number of imported files."""
+        try:
+            with open(json_path, 'r') as f:
+                inventory = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Could not import inventory {json_path}: {e}")
+            return 0
+        count = 0
+        with self.conn:
+            for comp_type, files in inventory.items():
+                for filename in files:
+                    self._upsert(comp_type, filename, {'upload_status': UPLOADED})
+                    count += 1
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)", (json_path,))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('initialized', ?)", (str(time.time()),))
+        logging.info(f"Imported {count} files from {json_path} into the inventory database {self.db_path}")
+        return count
+
+    def _upsert(self, comp_type, filename, fields: dict):
+        unknown = set(fields) - set(FILE_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown inventory fields: {unknown}")
+        fields = dict(fields, updated_at=time.time())
+        columns = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        updates = ', '.join(f"{column} = excluded.{column}" for column in fields)
+        self.conn.execute(f"INSERT INTO files (comp_type, filename, {columns}) VALUES (?, ?, {placeholders}) "
+                          f"ON CONFLICT (comp_type, filename) DO UPDATE SET {updates}",
+                          (comp_type, filename, *fields.values()))
+
+    def record(self, comp_type, filename, **fields):
+        """Insert or update the row of one file, e.g. `record('modules', 'a.txt', upload_status='uploaded')`."""
+        with self.conn:
+            self._upsert(comp_type, filename, fields)
+
+    def record_many(self, comp_type, filenames, **fields):
+        """Set the same fields on several files of comp_type in one transaction."""
+        with self.conn:
+            for filename in filenames:
+                self._upsert(comp_type, filename, fields)
+
+    def record_files(self, comp_type, files: dict):
+        """Update several files of comp_type in one transaction. files maps each filename to its fields."""
+        with self.conn:
+            for filename, fields in files.items():
+                self._upsert(comp_type, filename, fields)
+
+    def remove(self, comp_type, filenames=None) -> int:
+        """Remove files of comp_type from the inventory, or all of them if filenames is None, so that the next scan
+        finds them again as new files. Return the number of removed rows."""
+        with self.conn:
+            if filenames is None:
+                cursor = self.conn.execute("DELETE FROM files WHERE comp_type = ?", (comp_type,))
+            else:
+                cursor = self.conn.executemany("DELETE FROM files WHERE comp_type = ? AND filename = ?",
+                                               [(comp_type, filename) for filename in filenames])
+            # the directory itself did not change, so its recorded mtime would skip the removed files
+            self.conn.execute("DELETE FROM dirs WHERE comp_type = ?", (comp_type,))
+        return cursor.rowcount
+
+    def apply_scan(self, comp_type, new_files: dict, removed_files, dir_mtime=None, updated_files=None):
+        """Record the result of scanning one survey subdirectory in one transaction.
+
+        Parameters:
+        - new_files (dict): {filename: (size, mtime)} of files not in the inventory yet. They are added as pending.
+        - removed_files (iterable): Names of files that no longer exist.
+        - updated_files (dict): {filename: fields} of known files whose fingerprint changed.
+        - dir_mtime (float): Modification time of the subdirectory, so that it is skipped while unchanged. None to rescan next time."""
+        with self.conn:
+            for filename, (size, mtime) in new_files.items():
+                self._upsert(comp_type, filename, {'size': size, 'mtime': mtime})
+            for filename, fields in (updated_files or {}).items():
+                self._upsert(comp_type, filename, fields)
+            self.conn.executemany("DELETE FROM files WHERE comp_type = ? AND filename = ?",
+                                  [(comp_type, filename) for filename in removed_files])
+            if dir_mtime is None:
+                self.conn.execute("DELETE FROM dirs WHERE comp_type = ?", (comp_type,))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO dirs (comp_type, mtime) VALUES (?, ?)", (comp_type, dir_mtime))
+
+    def remove_dir(self, comp_type) -> int:
+        """Forget a survey subdirectory and all its files. Return the number of removed files."""
+        with self.conn:
+            self.conn.execute("DELETE FROM dirs WHERE comp_type = ?", (comp_type,))
+            cursor = self.conn.execute("DELETE FROM files WHERE comp_type = ?", (comp_type,))
+        return cursor.rowcount
+
+    def claim(self, comp_type, filenames, owner, lease_seconds=1800) -> list:
+        """Claim files for processing, so that other uploader processes skip them until the lease runs out.
+        Files already claimed by another owner with a running lease are not claimed.
+
+        Parameters:
+        - owner (str): Identifier of the claiming process, e.g. host:pid.
+        - lease_seconds (float): How long the claim holds if it is not released (e.g. the process died).
+
+        Return
+        - list: The filenames that were claimed, in the given order."""
+        now = time.time()
+        claimed = []
+        with self.conn:
+            for filename in filenames:
+                cursor = self.conn.execute(
+                    "UPDATE files SET claimed_by = ?, lease_until = ? WHERE comp_type = ? AND filename = ? "
+                    "AND (claimed_by IS NULL OR claimed_by = ? OR lease_until < ?)",
+                    (owner, now + lease_seconds, comp_type, filename, owner, now))
+                if cursor.rowcount:
+                    claimed.append(filename)
+        return claimed
+
+    def claimed_by_others(self, comp_type, owner) -> int:
+        """Number of files of comp_type claimed by other owners whose lease is still running."""
+        return self.conn.execute("SELECT COUNT(*) FROM files WHERE comp_type = ? AND claimed_by IS NOT NULL AND claimed_by != ? AND lease_until >= ?",
+                                 (comp_type, owner, time.time())).fetchone()[0]
+
+    def release(self, owner, comp_type=None, filenames=None):
+        """Release the claims of owner, on the given files of comp_type or on all of them."""
+        with self.conn:
+            if filenames is None:
+                query, params = "UPDATE files SET claimed_by = NULL, lease_until = NULL WHERE claimed_by = ?", [owner]
+                if comp_type:
+                    query += " AND comp_type = ?"
+                    params.append(comp_type)
+                self.conn.execute(query, params)
+            else:
+                self.conn.executemany("UPDATE files SET claimed_by = NULL, lease_until = NULL "
+                                      "WHERE claimed_by = ? AND comp_type = ? AND filename = ?",
+                                      [(owner, comp_type, filename) for filename in filenames])
+
+    def comp_types(self) -> list:
+        return [row['comp_type'] for row in self.conn.execute("SELECT DISTINCT comp_type FROM files ORDER BY comp_type")]
+
+    def tracked(self, comp_type=None) -> dict:
+        """Return {comp_type: [files]} of the files that need no processing (uploaded or skipped)."""
+        query = f"SELECT comp_type, filename FROM files WHERE upload_status IN ({', '.join('?' for _ in TRACKED_STATES)})"
+        params = list(TRACKED_STATES)
+        if comp_type:
+            query += " AND comp_type = ?"
+            params.append(comp_type)
+        inventory = {}
+        for row in self.conn.execute(query + " ORDER BY comp_type, filename", params):
+            inventory.setdefault(row['comp_type'], []).append(row['filename'])
+        return inventory
+
+    def pending(self, comp_type=None) -> dict:
+        """Return {comp_type: [files]} of the files still to be processed: new, failed or not attempted."""
+        query = f"SELECT comp_type, filename FROM files WHERE (upload_status IS NULL OR upload_status NOT IN ({', '.join('?' for _ in TRACKED_STATES)}))"
+        params = list(TRACKED_STATES)
+        if comp_type:
+            query += " AND comp_type = ?"
+            params.append(comp_type)
+        inventory = {}
+        for row in self.conn.execute(query + " ORDER BY comp_type, filename", params):
+            inventory.setdefault(row['comp_type'], []).append(row['filename'])
+        return inventory
+
+    def filenames(self, comp_type) -> set:
+        """Return the names of all files of comp_type in the inventory."""
+        return {row[0] for row in self.conn.execute("SELECT filename FROM files WHERE comp_type = ?", (comp_type,))}
+
+    def fingerprints(self, comp_type) -> dict:
+        """Return {filename: (size, mtime, hash, upload_status)} of all files of comp_type in the inventory."""
+        return {row['filename']: (row['size'], row['mtime'], row['hash'], row['upload_status'])
+                for row in self.conn.execute("SELECT filename, size, mtime, hash, upload_status FROM files WHERE comp_type = ?", (comp_type,))}
+
+    def dir_mtimes(self) -> dict:
+        """Return {comp_type: mtime} of the survey subdirectories at their last scan."""
+        return {row['comp_type']: row['mtime'] for row in self.conn.execute("SELECT comp_type, mtime FROM dirs")}
+
+    def rows(self, comp_type=None, upload_status=None) -> list:
+        """Return the rows (sqlite3.Row) of the files, optionally filtered by component type and upload status."""
+        query, params = "SELECT * FROM files WHERE 1 = 1", []
+        if comp_type:
+            query += " AND comp_type = ?"
+            params.append(comp_type)
+        if upload_status:
+            query += " AND upload_status = ?"
+            params.append(upload_status)
+        return self.conn.execute(query + " ORDER BY comp_type, filename", params).fetchall()
+
+    def count(self, comp_type=None) -> int:
+        if comp_type:
+            return self.conn.execute("SELECT COUNT(*) FROM files WHERE comp_type = ?", (comp_type,)).fetchone()[0]
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
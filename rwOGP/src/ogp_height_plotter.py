@@ -1,12 +1,12 @@
 import numpy as np
 import pandas as pd
-import os, re, yaml, logging, glob
+import os, re, yaml, logging, glob, time
 from rich.console import Console
 from rich.table import Table
 import matplotlib.pyplot as plt
 import matplotlib.colors as cls
-from src.parse_data import DataParser
-from src.param import pin_mapping, plot2d_dim, ADJUSTMENTS, angle_lookup, ANGLE_CALC_CONFIG, fd_maps
+from src.parse_data import DataParser, add_feature_index, CH_FD_NUMBERS, PROMPT_LOCK
+from src.param import pin_mapping, plot2d_dim, ADJUSTMENTS, angle_lookup, ANGLE_CALC_CONFIG
 
 pjoin = os.path.join
 
@@ -30,8 +30,9 @@ class PlotTool:
         self.meta = meta
         self.comp_type = component_type.rstrip('s')
         self.tray_dir = tray_dir
+        self.timings = {}  # {step: seconds} of get_offsets
         #! this is a hack
-        self.features = DataParser.get_xyz(features, ['Tray'])
+        self.features = DataParser.get_xyz(add_feature_index(features), excludeClass=['tray'])
         self.x_points = self.features['X_coordinate']
         self.y_points = self.features['Y_coordinate']
         self.z_points = self.features['Z_coordinate']
@@ -186,8 +187,9 @@ class PlotTool:
         """
         points_to_average = FDPoints[fd_indices]
         if np.any(np.isnan(points_to_average)):
-            logging.warning(f"NaN values found in FD points {[i+1 for i in fd_indices]} used for default calculation.")
-            userinput = input(f"Would you like to continue with the available points? (y/n): ")
+            with PROMPT_LOCK:
+                logging.warning(f"NaN values found in FD points {[i+1 for i in fd_indices]} used for default calculation.")
+                userinput = input(f"Would you like to continue with the available points? (y/n): ")
             if userinput.lower() != 'y':
                 raise ValueMissingError("Exiting... Please check the FD points and try again.")
             else:
@@ -300,33 +302,27 @@ class PlotTool:
 
         Return 
         - `FD_points`: 8 by 2 array of fiducial points, empty points are filled with np.nan"""
-        # Try FD keyword first
-        FD_points = self.features[self.features['FeatureName'].str.contains(r'FD\d+(?!\d)', case=False, regex=True)].copy()
-        if not FD_points.empty:
-            FD_points.loc[:, 'FD_number'] = FD_points['FeatureName'].apply(
-                lambda x: int(re.search(r'FD(\d+)(?!\d)', x, re.IGNORECASE).group(1)) if re.search(r'FD(\d+)(?!\d)', x, re.IGNORECASE) else 0
-            )
-        else:
+        # Try FD keyword first, using the feature index computed at parse time
+        FD_points = self.features[self.features['FD_number'] > 0]
+        FD_numbers = FD_points['FD_number'].values
+        if FD_points.empty:
             # Try CH keyword if FD not found
-            def get_fd_number(name):
-                for idx, fd_id in enumerate(fd_maps):
-                    pattern = fr'CH{fd_id}(?!\d)'
-                    if re.search(pattern, name, flags=re.IGNORECASE):
-                        return idx + 1
-                return None
-            FD_points = self.features.copy()
-            FD_points['FD_number'] = FD_points['FeatureName'].apply(get_fd_number)
-            FD_points = FD_points.dropna(subset=['FD_number'])
+            FD_points = self.features[self.features['CH_channel'].isin(list(CH_FD_NUMBERS))]
+            FD_numbers = FD_points['CH_channel'].map(CH_FD_NUMBERS).values
             if FD_points.empty:
                 logging.warning("No fiducial points found with either 'FD' or 'CH' keyword.")
                 return False
-            
-        FD_points['FD_number'] = FD_points['FD_number'].astype(int)
-        
+
         FD_names = FD_points['FeatureName'].values
-        FD_numbers = FD_points['FD_number'].values
-        logging.info(f"Found fiducial positions in {FD_names} with numbers {FD_numbers}")
         x_y_coords = FD_points[['X_coordinate', 'Y_coordinate']].values
+        return self._assemble_FDs(FD_names, FD_numbers, x_y_coords)
+
+    def _assemble_FDs(self, FD_names, FD_numbers, x_y_coords) -> np.array:
+        """Place the matched fiducial coordinates into an 8 by 2 array indexed by FD number."""
+        FD_names = np.asarray(FD_names)
+        FD_numbers = np.asarray(FD_numbers, dtype=int)
+        x_y_coords = np.asarray(x_y_coords, dtype=float).reshape(-1, 2)
+        logging.info(f"Found fiducial positions in {FD_names} with numbers {FD_numbers}")
         num_FDs = len(x_y_coords)
         if not num_FDs in {2, 4, 6, 8}:
             comp_id = self.meta.get('ComponentID', 'unknown')
@@ -335,6 +331,7 @@ class PlotTool:
         
         sort_indices = np.argsort(FD_numbers)
         FD_points = x_y_coords[sort_indices]
+        FD_numbers = FD_numbers[sort_indices]
         logging.info(f"Found {num_FDs} fiducial points: {FD_names}")
 
         FD_array = np.full((8,2), np.nan)
@@ -485,22 +482,31 @@ class PlotTool:
 
         return hole_pin_xy, slot_pin_xy
     
-    def get_offsets(self):
+    def get_offsets(self, plot=True):
         """Get the offsets of the sensor from the tray fiducials.
 
+        Parameters
+        - `plot`: save the fiducial plot right away. Otherwise call `plot_FDs` later, e.g. from a rendering stage.
+
         Return
         - `XOffset`: x-offset of the sensor from the tray center
         - `YOffset`: y-offset of the sensor from the tray center
         - `AngleOff`: angle of the sensor from the tray fiducials"""
         
+        start = time.perf_counter()
         HolePin_xy, SlotPin_xy = self.get_pin_coordinates()
         PositionID = self.meta['PositionID']
 
         FD_points = self.get_FDs()
+        self.FD_points, self.pin_xy = FD_points, (HolePin_xy, SlotPin_xy)
+        self.timings['fd_extraction'] = time.perf_counter() - start
 
-        plotFD(FD_points, HolePin_xy, SlotPin_xy, True, pjoin(self.save_dir, f"{self.meta['ComponentID']}_FDpoints.png"))
+        if plot:
+            self.plot_FDs()
 
+        start = time.perf_counter()
         CenterOff, AngleOff, XOffset, YOffset = self.angle(HolePin_xy, SlotPin_xy, FD_points)
+        self.timings['offsets'] = time.perf_counter() - start
 
         if abs(AngleOff) > 20:
             logging.error("The calculated angle offset is too large. Check the fiducial points and the sensor position (Pos 1 vs. 2)")
@@ -511,6 +517,14 @@ class PlotTool:
 
         return XOffset, YOffset, AngleOff
 
+    def plot_FDs(self):
+        """Save the plot of the fiducial points and pins found by `get_offsets`."""
+        HolePin_xy, SlotPin_xy = self.pin_xy
+        plotFD(self.FD_points, HolePin_xy, SlotPin_xy, True, self.FD_plot_path())
+
+    def FD_plot_path(self) -> str:
+        return pjoin(self.save_dir, f"{self.meta['ComponentID']}_FDpoints.png")
+
     @staticmethod
     def _calculate_height_stats(zheight):
         """Calculate basic height statistics."""
@@ -0,0 +1,90 @@
+import os, hashlib, logging
+from src.parse_data import save_survey_npz, load_survey_npz
+
+pjoin = os.path.join
+
+class ParseCache():
+    """On-disk cache of parsed surveys, keyed by a hash of the preprocessed survey text.
+    Each entry is a single .npz file holding the raw parsed header and the feature arrays.
+    Entries are evicted least-recently-used first once there are more than `max_entries`."""
+    suffix = '.npz'
+
+    def __init__(self, cache_dir, max_entries=5000):
+        """Initialize the cache.
+
+        Parameters:
+        - cache_dir (str): Directory holding the cache entries. Created if missing.
+        - max_entries (int): Maximum number of entries kept by `evict`. None for unbounded."""
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(data: str, header_template: str) -> str:
+        """Cache key of a preprocessed survey text. The header template is part of the key since it changes the parsed header."""
+        digest = hashlib.sha256()
+        digest.update(header_template.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(data.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key) -> str:
+        return pjoin(self.cache_dir, f"{key}{self.suffix}")
+
+    def get(self, key):
+        """Return the cached (header, features) for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            cached = load_survey_npz(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Discarding unreadable parse cache entry {path}: {e}")
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return cached
+
+    def put(self, key, header: dict, features: dict):
+        """Store the parse results for key."""
+        try:
+            save_survey_npz(self._path(key), header, features)
+        except OSError as e:
+            logging.warning(f"Could not write parse cache entry for {key}: {e}")
+
+    def entries(self) -> list:
+        """Return (mtime, path) of all cache entries, least recently used first."""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.suffix):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        return sorted(entries)
+
+    def evict(self, max_entries=None) -> int:
+        """Remove the least recently used entries beyond max_entries (default `self.max_entries`).
+        Return the number of removed entries."""
+        max_entries = self.max_entries if max_entries is None else max_entries
+        if max_entries is None:
+            return 0
+        entries = self.entries()
+        stale = entries[:max(0, len(entries) - max_entries)]
+        for _, path in stale:
+            self._remove(path)
+        if stale:
+            logging.debug(f"Evicted {len(stale)} entries from the parse cache {self.cache_dir}")
+        return len(stale)
+
+    def clear(self) -> int:
+        """Remove all cache entries. Return the number of removed entries."""
+        return self.evict(0)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
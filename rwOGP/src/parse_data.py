@@ -1,13 +1,18 @@
-import os, yaml, logging, re
-from ttp import ttp
+import os, io, yaml, logging, re, json, hashlib, threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from functools import lru_cache
+from typing import NamedTuple
+import numpy as np
 import pandas as pd
 from io import StringIO
 from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
 from rich.table import Table
-from src.param import default_params, pin_mapping
-from src.parser_template import data_template, required_keys, warning_keys, header_template_bp_hxb, header_template_pm_module
+from src.param import default_params, pin_mapping, fd_maps
+from src.profiling import release_inherited_profiler
+from src.parser_template import data_template, required_keys, warning_keys, header_template_bp_hxb, header_template_pm_module, feature_columns, feature_index_columns
 
 pjoin = os.path.join
 pbase = os.path.basename
@@ -15,9 +20,16 @@ pbase = os.path.basename
 class ParserKeyException(Exception):
     pass
 
+# Surveys of several component types are checked in worker threads at once. Code asking the operator a question
+# holds this lock while it prints the problem and reads the answers, so that the questions stay readable.
+PROMPT_LOCK = threading.Lock()
+
+KEY_VALUE_PATTERN = re.compile(r"^(?P<key>[A-Za-z0-9_ ]+):\s*(?P<value>.*?)\s*$")
+TEMPLATE_VAR_PATTERN = re.compile(r"\{\{\s*(\w+)")
+
 def parse_key_values(text):
     """Parse key-value pairs from a text string."""
-    pattern = re.compile(r"^(?P<key>[A-Za-z0-9_ ]+):\s*(?P<value>.*?)\s*$")
+    pattern = KEY_VALUE_PATTERN
     results = {}
     for line in text.splitlines():
         match = pattern.match(line)
@@ -27,43 +39,385 @@ def parse_key_values(text):
             results[key] = value
     return results
 
+def preprocess_survey_line(line: str):
+    """Clean a single survey line. Return None for lines that should be skipped."""
+    line = line.strip().replace('\t', ' ')  # remove tabs
+    if not line:
+        return None  # skip empty lines
+
+    if ':' in line:
+        key, value = line.split(':', 1)
+        key = key.strip()
+        value = value.strip()
+        # If value is missing, assign empty string
+        if not value:
+            value = '""'
+        return f"{key}: {value}"
+    # Possibly a malformed line, you may choose to skip or handle differently
+    return line
+
 def preprocess_survey_data(raw_text: str) -> str:
     """Preprocess survey data by cleaning and formatting the text."""
     cleaned_lines = []
     for line in raw_text.strip().splitlines():
-        line = line.strip().replace('\t', ' ')  # remove tabs
-        if not line:
-            continue  # skip empty lines
-
-        if ':' in line:
-            key, value = line.split(':', 1)
-            key = key.strip()
-            value = value.strip()
-            # If value is missing, assign empty string
-            if not value:
-                value = '""'
-            cleaned_lines.append(f"{key}: {value}")
-        else:
-            # Possibly a malformed line, you may choose to skip or handle differently
-            cleaned_lines.append(line.strip())
+        line = preprocess_survey_line(line)
+        if line is not None:
+            cleaned_lines.append(line)
 
     return '\n'.join(cleaned_lines)
 
+class FeatureRecord(NamedTuple):
+    """One surveyed feature. Fields follow `feature_columns`; missing values are NaN."""
+    FeatureType: str
+    FeatureName: str
+    X_coordinate: float
+    Y_coordinate: float
+    Z_coordinate: float
+    I_coordinate: float
+    J_coordinate: float
+    K_coordinate: float
+    Radius: float
+
+class FileFingerprint(NamedTuple):
+    """Size, mtime and SHA-256 of a survey file as it was read, see `read_survey_file`."""
+    size: int
+    mtime: float
+    hash: str
+
+def read_survey_file(filename) -> tuple[str, FileFingerprint]:
+    """Read the text of a survey file and fingerprint the contents read.
+    The file is stat'ed before reading, so a file rewritten meanwhile has a newer mtime on disk than its fingerprint."""
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        raw = f.read()
+    text = io.TextIOWrapper(io.BytesIO(raw)).read()  # decoded like open(filename, 'r')
+    return text, FileFingerprint(stat.st_size, stat.st_mtime, hashlib.sha256(raw).hexdigest())
+
+def compile_header_template(header_template: str) -> tuple[dict, list]:
+    """Compile a TTP header template into a lookup of header keys to template variable names.
+
+    Return
+    - key_map (dict): {header key: [variable names]}, e.g. {'Runtime': ['RunDate', 'RunTime']}
+    - free_vars (list): variables on lines without a key, e.g. ['ProjectName']"""
+    key_map = {}
+    free_vars = []
+    for line in header_template.strip().splitlines():
+        if ':' in line:
+            key, rest = line.split(':', 1)
+            key_map[key.strip()] = TEMPLATE_VAR_PATTERN.findall(rest)
+        else:
+            free_vars.extend(TEMPLATE_VAR_PATTERN.findall(line))
+    return key_map, free_vars
+
+def parse_header_lines(lines, header_template: str) -> dict:
+    """Parse preprocessed header lines in one pass.
+
+    Produces the same keys as the TTP header template merged with `parse_key_values`:
+    the raw `key: value` pairs plus the template variable names (e.g. ComponentID, RunDate)."""
+    key_map, free_vars = compile_header_template(header_template)
+    template_results = {}
+    raw_results = {}
+    for line in lines:
+        match = KEY_VALUE_PATTERN.match(line)
+        if match is None:
+            tokens = line.split()
+            if len(tokens) == 1 and free_vars and free_vars[0] not in template_results:
+                template_results[free_vars[0]] = tokens[0]
+            continue
+        key, value = match.group('key').strip(), match.group('value').strip()
+        raw_results[key] = value
+        names = key_map.get(key)
+        if names:
+            # TTP variables match single words, so only map values with the expected word count
+            words = value.split()
+            if len(words) == len(names):
+                template_results.update(zip(names, words))
+    template_results.update(raw_results)
+    return template_results
+
+def _to_float(token: str) -> float:
+    try:
+        return float(token)
+    except ValueError:
+        return np.nan
+
+def iter_feature_records(lines):
+    """Yield one `FeatureRecord` per surveyed feature from preprocessed feature lines.
+
+    A feature block looks like
+    ```
+    Circle Pos1_FD3
+    Point       140.759    368.086    3.869
+    direction cosine:        0.002   -0.002   0.999
+    Radius                0.2114
+    ```
+    where the `direction cosine` and `Radius` lines are optional."""
+    nan = np.nan
+    record = None
+    for line in lines:
+        tokens = line.split()
+        if not tokens:
+            continue
+        head = tokens[0]
+        if head == 'Point' and len(tokens) == 4 and not np.isnan(_to_float(tokens[1])):
+            if record is not None:
+                record[2:5] = [_to_float(t) for t in tokens[1:]]
+        elif line.startswith('direction cosine:'):
+            if record is not None:
+                for offset, token in enumerate(tokens[2:5]):
+                    record[5 + offset] = _to_float(token)
+        elif head == 'Radius' and len(tokens) == 2:
+            if record is not None:
+                record[8] = _to_float(tokens[1])
+        elif len(tokens) >= 2:
+            if record is not None:
+                yield FeatureRecord(*record)
+            record = [head, ' '.join(tokens[1:]), nan, nan, nan, nan, nan, nan, nan]
+    if record is not None:
+        yield FeatureRecord(*record)
+
+FD_PATTERN = re.compile(r'FD(\d+)(?!\d)', re.IGNORECASE)
+CH_PATTERN = re.compile(r'CH(\d+)(?!\d)', re.IGNORECASE)
+POSITION_PATTERN = re.compile(r'^Pos(\d+)(?!\d)', re.IGNORECASE)
+# FD number of each fiducial channel in `fd_maps`, e.g. {111: 3}
+CH_FD_NUMBERS = {channel: idx + 1 for idx, channel in enumerate(fd_maps)}
+
+@lru_cache(maxsize=4096)
+def classify_feature_name(name: str) -> tuple[int, int, int, str]:
+    """Classify a feature name once, so that lookups downstream do not need to scan names with regexes.
+    Feature names repeat across surveys, so results are memoized.
+
+    Return
+    - FD_number (int): N of `FDN` in the name (e.g. Pos1_FD3), 0 if none.
+    - CH_channel (int): Channel of `CHN` in the name, preferring channels listed in `fd_maps`, 0 if none.
+    - Position (int): N of a leading `PosN` prefix, 0 if none.
+    - FeatureClass (str): 'tray', 'fiducial', 'thickness', 'flatness' or 'other'."""
+    match = FD_PATTERN.search(name)
+    fd_number = int(match.group(1)) if match else 0
+    channels = [int(channel) for channel in CH_PATTERN.findall(name)]
+    mapped = [channel for channel in channels if channel in CH_FD_NUMBERS]
+    if mapped:
+        ch_channel = min(mapped, key=CH_FD_NUMBERS.get)
+    else:
+        ch_channel = channels[0] if channels else 0
+    match = POSITION_PATTERN.match(name)
+    position = int(match.group(1)) if match else 0
+
+    lowered = name.lower()
+    if 'tray' in lowered:
+        feature_class = 'tray'
+    elif fd_number or ch_channel in CH_FD_NUMBERS or 'fiducial' in lowered:
+        feature_class = 'fiducial'
+    elif 'thickness' in lowered:
+        feature_class = 'thickness'
+    elif 'flat' in lowered or 'plane' in lowered:
+        feature_class = 'flatness'
+    else:
+        feature_class = 'other'
+    return fd_number, ch_channel, position, feature_class
+
+def feature_name_index(names) -> dict:
+    """Classify feature names into typed column arrays keyed by `feature_index_columns`. Missing names are class 'other'."""
+    classified = [classify_feature_name(name) if isinstance(name, str) else (0, 0, 0, 'other') for name in names]
+    columns = list(zip(*classified)) or [()] * len(feature_index_columns)
+    return {'FD_number': np.array(columns[0], dtype=np.int16),
+            'CH_channel': np.array(columns[1], dtype=np.int16),
+            'Position': np.array(columns[2], dtype=np.int8),
+            'FeatureClass': np.array(columns[3], dtype=object)}
+
+def add_feature_index(df: pd.DataFrame) -> pd.DataFrame:
+    """Add the `feature_index_columns` to a feature dataframe parsed before they existed (e.g. older csv outputs).
+    Dataframes that already have them are returned unchanged."""
+    if all(column in df.columns for column in feature_index_columns):
+        return df
+    df = df.copy()
+    for name, values in feature_name_index(df['FeatureName'].to_numpy()).items():
+        df[name] = values
+    return df
+
+def records_to_arrays(records) -> dict:
+    """Collect feature records into typed NumPy column arrays keyed by `feature_columns`, plus the `feature_index_columns`."""
+    columns = list(zip(*records))
+    if not columns:
+        columns = [()] * len(feature_columns)
+    arrays = {}
+    for name, values in zip(feature_columns, columns):
+        if name in ('FeatureType', 'FeatureName'):
+            arrays[name] = np.array(values, dtype=object)
+        else:
+            arrays[name] = np.array(values, dtype=np.float64)
+    arrays.update(feature_name_index(arrays['FeatureName']))
+    return arrays
+
+def parse_survey_text(text: str, header_template: str, delimiter='---') -> tuple[dict, dict]:
+    """Parse preprocessed survey text into the header dictionary and feature arrays in a single pass.
+
+    Return
+    - header (dict): Header key-value pairs, as produced by the TTP header template.
+    - features (dict): {column: np.ndarray} for every column in `feature_columns` and `feature_index_columns`."""
+    lines = text.splitlines()
+    delimiters = [i for i, line in enumerate(lines) if line.strip() == delimiter]
+    if len(delimiters) != 1:
+        raise ParserKeyException(f"Exactly one '{delimiter}' delimiter is required between header and features, found {len(delimiters)}.")
+    split = delimiters[0]
+    header = parse_header_lines(lines[:split], header_template)
+    features = records_to_arrays(iter_feature_records(lines[split + 1:]))
+    return header, features
+
+def save_survey_npz(path, header: dict, features: dict):
+    """Save a parsed survey (header dictionary and feature arrays) to a single uncompressed .npz file.
+    The file is written to a temporary name first and then renamed, so readers never see a partial file."""
+    arrays = {}
+    for name, values in features.items():
+        values = np.asarray(values)
+        arrays[name] = values.astype(str) if values.dtype == object else values
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, __header__=np.array(json.dumps(header)), **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_survey_npz(path) -> tuple[dict, dict]:
+    """Load a parsed survey saved by `save_survey_npz`. No text is parsed except the small JSON header.
+
+    Return
+    - header (dict), features (dict): As returned by `parse_survey_text`."""
+    features = {}
+    with np.load(path, allow_pickle=False) as archive:
+        header = json.loads(str(archive['__header__']))
+        for name in archive.files:
+            if name == '__header__':
+                continue
+            values = archive[name]
+            features[name] = np.array(values, dtype=object) if values.dtype.kind == 'U' else values
+    return header, features
+
+def load_parsed_survey(feature_file, meta_file=None) -> tuple[dict, pd.DataFrame]:
+    """Load a survey written by `DataParser`, either a single .npz file or a .csv with its _meta.yaml.
+
+    Return
+    - metadata (dict): Checked header of the survey.
+    - features (pd.DataFrame): Parsed feature results."""
+    if feature_file.endswith('.npz'):
+        metadata, features = load_survey_npz(feature_file)
+        return metadata, add_feature_index(pd.DataFrame(features))
+    with open(meta_file, 'r') as f:
+        metadata = yaml.safe_load(f)
+    return metadata, add_feature_index(pd.read_csv(feature_file))
+
+class ParsedSurvey():
+    """A parsed and checked survey held in memory: the header dictionary and the feature dataframe.
+    Passed from DataParser to SurveyProcessor directly, without a round trip through the parsed output files."""
+    def __init__(self, name, header: dict, features: pd.DataFrame, source=None, fingerprint: FileFingerprint = None):
+        """Parameters:
+        - name (str): Filename prefix of the parsed outputs, based on ComponentID and Operator.
+        - header (dict): Checked header (metadata) of the survey.
+        - features (pd.DataFrame): Parsed feature results.
+        - source (str): Path of the survey file (or parsed output) this survey was read from.
+        - fingerprint (FileFingerprint): Of the survey file as it was parsed, if parsed from one."""
+        self.name = name
+        self.header = header
+        self.features = features
+        self.source = source
+        self.fingerprint = fingerprint
+
+    def __repr__(self):
+        return f"ParsedSurvey({self.name!r}, {len(self.features)} features)"
+
+    def write(self, output_dir, output_format='npz') -> tuple[str, str]:
+        """Write the survey to output_dir in the given format (see `DataParser`).
+
+        Return
+        - meta_file (str), feature_file (str): Paths that `load_parsed_survey` and `SurveyProcessor` accept."""
+        meta_file = pjoin(output_dir, f'{self.name}_meta.yaml')
+        feature_file = pjoin(output_dir, f'{self.name}.csv')
+        if output_format in ('csv', 'both'):
+            with open(meta_file, 'w') as f:
+                yaml.dump(self.header, f, default_flow_style=False)
+            self.features.to_csv(feature_file, index=False)
+        if output_format in ('npz', 'both'):
+            feature_file = pjoin(output_dir, f'{self.name}.npz')
+            meta_file = feature_file
+            features = {name: self.features[name].to_numpy() for name in self.features.columns}
+            save_survey_npz(feature_file, self.header, features)
+        return meta_file, feature_file
+
+    @classmethod
+    def load(cls, feature_file, meta_file=None):
+        """Load a survey written by `write` (or by `DataParser`)."""
+        header, features = load_parsed_survey(feature_file, meta_file)
+        return cls(pbase(feature_file).rsplit('.', 1)[0], header, features, feature_file)
+
+def parse_survey_file(filename, header_template: str, backup_dir=None, cache=None, delimiter='---') -> tuple[dict, dict, FileFingerprint]:
+    """Read, preprocess and parse one survey file. Non-interactive, so it can run in a worker process.
+
+    Parameters:
+    - filename (str): Path to the OGP survey output file.
+    - header_template (str): Header template matching the component type.
+    - backup_dir (str): If given, a preprocessed copy of the file is saved there (once).
+    - cache (ParseCache): If given, surveys with identical preprocessed content are only parsed once.
+
+    Return
+    - header (dict), features (dict): As returned by `parse_survey_text`.
+    - fingerprint (FileFingerprint): Of the file contents that were parsed."""
+    text, fingerprint = read_survey_file(filename)
+    data = preprocess_survey_data(text)
+
+    if backup_dir is not None:
+        backup_file = pjoin(backup_dir, pbase(filename))
+        if not os.path.exists(backup_file):
+            with open(backup_file, 'w') as f:
+                f.write(data)
+
+    if cache is None:
+        return *parse_survey_text(data, header_template, delimiter), fingerprint
+
+    key = cache.key(data, header_template)
+    cached = cache.get(key)
+    if cached is not None:
+        logging.debug(f"Using cached parse results for {pbase(filename)}")
+        return *cached, fingerprint
+    header, features = parse_survey_text(data, header_template, delimiter)
+    cache.put(key, header, features)
+    return header, features, fingerprint
+
+def _try_parse_survey_file(*args):
+    """`parse_survey_file`, returning the exception instead of raising it, so that one unreadable file does not end a batch."""
+    try:
+        return parse_survey_file(*args)
+    except Exception as e:
+        return e
 
 class DataParser():
     """Parse data file(s) using TTP template. 
     Output metadata, which contains info such as geometry and density, and feature results, which are dataframes containing the parsed data."""
-    def __init__(self, data_file, output_dir):
+    output_formats = ('npz', 'csv', 'both')
+
+    def __init__(self, data_file, output_dir, workers=1, cache=None, output_format='npz'):
         """Initialize DataParser object.
         
         Parameters:
         - data_file (str/list[str]): Path(s) to the data output file by OGP surveys to be parsed.
-        - output_dir (str): Path to the output directory of the parsed data."""
+        - output_dir (str): Path to the output directory of the parsed data.
+        - workers (int): Number of processes parsing files in parallel. 1 parses in this process; None uses all cores.
+        - cache (ParseCache): Optional cache of parse results keyed by survey content.
+        - output_format (str): 'npz' writes one binary file per survey holding header and features,
+        'csv' writes a feature csv and a _meta.yaml file (human readable), 'both' writes all three."""
         if isinstance(data_file, str):
             data_file = [data_file]
+        if output_format not in self.output_formats:
+            raise ParserKeyException(f"Output format {output_format} not recognized. Choose from {self.output_formats}.")
+        self.output_format = output_format
         
         self.data_file = data_file
         self.output_dir = output_dir
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.cache = cache
+        self.parse_errors = {}  # {filename: reason} of the files iter_surveys skipped
         self._comp_type = pbase(self.output_dir).rstrip('s')
 
         if self._comp_type == 'hexaboard' or self._comp_type == 'baseplate':
@@ -92,41 +446,67 @@ class DataParser():
             raise ParserKeyException(f"Error creating output directory: {e}")
     
     def __call__(self) -> tuple:
-        """Parse data file produced by default OGP template. Create metadata file and output feature results to a csv file.
+        """Parse data file produced by default OGP template. Output metadata and feature results in `self.output_format`.
         
         Return 
-        - gen_meta (list): List of metadata files generated.
+        - gen_meta (list): List of metadata files generated. Same as gen_features for the npz format.
         - gen_features (list): List of feature files generated."""
         gen_meta = []
         gen_features = []
+        for survey in self.iter_surveys():
+            meta_file, feature_file = survey.write(self.output_dir, self.output_format)
+            gen_features.append(feature_file)
+            gen_meta.append(meta_file)
+        return gen_meta, gen_features
+
+    def iter_surveys(self):
+        """Parse and check every file in `self.data_file` without writing any output.
+
+        Return
+        - iterator of `ParsedSurvey`, in file order. Files that cannot be parsed or whose header checks fail are skipped,
+        with the reason kept in `self.parse_errors`."""
         logging.info("=== Parsing OGP Data ===")
-        for filename in self.data_file:
-            self.header_results = {}
-            with open(filename, 'r') as f:
-                self.data = f.read()
-            logging.info(f"Parsing data file: {pbase(filename)}")
-
-            self.data = preprocess_survey_data(self.data)
-
-            backup_file = pjoin(self.backup_dir, pbase(filename))
-            if not os.path.exists(backup_file):
-                with open(backup_file, 'w') as f:
-                    f.write(self.data)
-            
-            self.read_temp_sep(self.header_template)
+        # Interactive checks in check_meta always run here, in file order, after the (parallel) parsing
+        for filename, result in zip(self.data_file, self.parse_all()):
+            if isinstance(result, Exception):
+                logging.error(f"Error in parsing {filename}: {result}")
+                self.parse_errors[filename] = f"{type(result).__name__}: {result}"
+                continue
+            header, features, fingerprint = result
+            self.header_results = header
+            # Cache entries written before the feature index columns existed lack them
+            self.feature_results = add_feature_index(pd.DataFrame(features).drop_duplicates())
             try:
-                output_filename = self.output_meta()
+                output_filename = self.check_meta()
             except ParserKeyException as e:
                 logging.error(f"Error in parsing metadata: {e} for {filename}")
+                self.parse_errors[filename] = f"Metadata: {e}"
                 continue
-            self.output_features(f'{output_filename}.csv')
-
-            gen_features.append(pjoin(self.output_dir, f'{output_filename}.csv'))
-            gen_meta.append(pjoin(self.output_dir, f'{output_filename}_meta.yaml'))
-        return gen_meta, gen_features
+            yield ParsedSurvey(output_filename, self.header_results, self.feature_results, filename, fingerprint)
+
+    def parse_all(self):
+        """Parse every file in `self.data_file`, in order. Fan out to a process pool if `self.workers` > 1.
+
+        Return
+        - iterator of (header, features, fingerprint) tuples, in the same order as `self.data_file`. For files that could not be parsed,
+        the exception raised instead."""
+        files = self.data_file
+        workers = min(self.workers, len(files))
+        if workers <= 1:
+            for filename in files:
+                logging.info(f"Parsing data file: {pbase(filename)}")
+                yield _try_parse_survey_file(filename, self.header_template, self.backup_dir, self.cache)
+            return
+
+        logging.info(f"Parsing {len(files)} data files with {workers} worker processes")
+        chunksize = max(1, len(files) // (workers * 4))
+        # workers forked while profiling (--profile) would keep running the inherited profiler
+        with ProcessPoolExecutor(max_workers=workers, initializer=release_inherited_profiler) as executor:
+            yield from executor.map(_try_parse_survey_file, files, repeat(self.header_template), repeat(self.backup_dir), repeat(self.cache), chunksize=chunksize)
 
     def read_temp_sep(self, header_template, feature_template=data_template, delimiter='---'):
         """Read data file produced with header and feature templates separated by a delimiter."""
+        from ttp import ttp
         parts = self.data.split(delimiter)
         
         assert len(parts) == 2, 'Exactly One delimiter is required'
@@ -144,7 +524,7 @@ class DataParser():
             self.header_results.update(header)
         self.header_results.update(alt_header_results)
 
-        self.feature_results = pd.read_csv(StringIO(feature_results[0])).drop_duplicates()
+        self.feature_results = add_feature_index(pd.read_csv(StringIO(feature_results[0])).drop_duplicates())
         
         return header_results, feature_results
     
@@ -157,6 +537,15 @@ class DataParser():
         
         Return 
         - filename (str): Filename prefix of the metadata file."""
+        filename = self.check_meta()
+        self.write_meta(filename)
+        return filename
+
+    def check_meta(self) -> str:
+        """Check the parsed header in place, prompting the user if needed.
+        
+        Return 
+        - filename (str): Filename prefix for the outputs, based on ComponentID and Operator."""
         header_dict = self.header_results
 
         header_dict = self.check_missing_keys(header_dict)
@@ -164,11 +553,14 @@ class DataParser():
         header_dict = self.check_missing_mappings(header_dict)
         header_dict = self.check_illegal_chars(header_dict)
 
-        filename = f"{header_dict['ComponentID']}_{header_dict['Operator']}"
+        self.header_results = header_dict
+        return f"{header_dict['ComponentID']}_{header_dict['Operator']}"
+
+    def write_meta(self, filename):
+        """Write the checked metadata to {filename}_meta.yaml."""
         meta_file = f'{filename}_meta.yaml'
         with open(f'{self.output_dir}/{meta_file}', 'w') as f:
-            yaml.dump(header_dict, f, default_flow_style=False)
-        return filename
+            yaml.dump(self.header_results, f, default_flow_style=False)
     
     def check_missing_keys(self, header_dict):
         """Check for missing keys in the parsed header. 
@@ -184,20 +576,21 @@ class DataParser():
                     warning_text.append(f"• {key}\n", style="red dim")
 
                 header_dict = self.adopt_default(header_dict)
-                console.print(Panel(
-                    warning_text,
-                    title="[red]Error[/red]",
-                    border_style="red",
-                    expand=False
-                ))
-
-                user_input = input("Do you want to enter values for the missing keys? (y/n): ")
-                if user_input.lower() != 'y':
-                    raise ParserKeyException(f"Missing keys not resolved! Exiting...")
-                else:
-                    for key in missing_keys:
-                        value = input(f"Enter value for {key}: ")
-                        header_dict[key] = value
+                with PROMPT_LOCK:
+                    console.print(Panel(
+                        warning_text,
+                        title="[red]Error[/red]",
+                        border_style="red",
+                        expand=False
+                    ))
+
+                    user_input = input("Do you want to enter values for the missing keys? (y/n): ")
+                    if user_input.lower() != 'y':
+                        raise ParserKeyException(f"Missing keys not resolved! Exiting...")
+                    else:
+                        for key in missing_keys:
+                            value = input(f"Enter value for {key}: ")
+                            header_dict[key] = value
             elif logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
                 success_text = Text()
                 success_text.append(f"All required keys detected for {header_dict['ComponentID']}!\n", style="green")
@@ -257,10 +650,11 @@ class DataParser():
             has_illegal = any(char in header_dict[field] for char in illegal_chars)
             if has_illegal:
                 original = header_dict[field]
-                logging.warning(f"Unconventional character(s) detected in {field}: {original}")
                 found_chars = [char for char in illegal_chars if char in original]
-                logging.warning(f"Found illegal characters: {found_chars}")
-                user_in = input("Would you want to remove these characters? If not the parsing might not continue correctly. (y/n): ")
+                with PROMPT_LOCK:
+                    logging.warning(f"Unconventional character(s) detected in {field}: {original}")
+                    logging.warning(f"Found illegal characters: {found_chars}")
+                    user_in = input("Would you want to remove these characters? If not the parsing might not continue correctly. (y/n): ")
                 if user_in.lower() == 'y':
                     cleaned_value = original
                     for char in illegal_chars:
@@ -287,15 +681,17 @@ class DataParser():
         Geometry = header_dict['Geometry']
         density = header_dict['Density']
         if pin_mapping.get(Geometry) is None:
-            logging.warning(f"Geometry {Geometry} not recognized. Default to Full.")
-            user_input = input("Do you want to adopt the default values for Geometry? (y/n): ")
+            with PROMPT_LOCK:
+                logging.warning(f"Geometry {Geometry} not recognized. Default to Full.")
+                user_input = input("Do you want to adopt the default values for Geometry? (y/n): ")
             if user_input.lower() != 'y':
                 raise ParserKeyException("Exiting... Please check the Geometry value or update the pin mapping in param.py.")
             header_dict['Geometry'] = 'Full'
             Geometry = 'Full'
         if pin_mapping.get(Geometry).get(density) is None:
-            logging.warning(f"Density {density} not recognized for Geometry {Geometry}. Default to LD.")
-            user_input = input("Do you want to adopt the default values for Density? (y/n): ")
+            with PROMPT_LOCK:
+                logging.warning(f"Density {density} not recognized for Geometry {Geometry}. Default to LD.")
+                user_input = input("Do you want to adopt the default values for Density? (y/n): ")
             if user_input.lower() != 'y':
                 raise ParserKeyException("Exiting... Please check the Density value or update the pin mapping in param.py.")
             header_dict['Density'] = 'LD'
@@ -322,10 +718,16 @@ class DataParser():
         return header_dict
     
     @staticmethod
-    def get_xyz(df: pd.DataFrame, filterKwd=[]) -> pd.DataFrame:
-        """Get X, Y, Z coordinates from the dataframe."""
-        if filterKwd: regex_pattern = '|'.join(filterKwd)
-        df = df[~df['FeatureName'].str.contains(regex_pattern, case=False, na=False)]
+    def get_xyz(df: pd.DataFrame, filterKwd=[], excludeClass=[]) -> pd.DataFrame:
+        """Get X, Y, Z coordinates from the dataframe.
+
+        Parameters:
+        - filterKwd (list): Drop features whose name contains any of these keywords (case insensitive).
+        - excludeClass (list): Drop features whose `FeatureClass` is one of these, e.g. ['tray']. Needs no regex scan."""
+        if filterKwd:
+            df = df[~df['FeatureName'].str.contains('|'.join(filterKwd), case=False, na=False)]
+        if excludeClass:
+            df = df[~df['FeatureClass'].isin(excludeClass)]
         return df.dropna(subset=['X_coordinate', 'Y_coordinate', 'Z_coordinate'])
     
     @staticmethod
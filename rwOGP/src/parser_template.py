@@ -49,6 +49,12 @@ data_template_simple = """
 Point\s+{{X_coordinate | float}}\s+{{Y_coordinate | float}}\s+{{Z_coordinate | float | default(None)}}
 """
 
+# Columns of the parsed feature results, in the order the native parser emits them
+feature_columns = ['FeatureType', 'FeatureName', 'X_coordinate', 'Y_coordinate', 'Z_coordinate',
+                   'I_coordinate', 'J_coordinate', 'K_coordinate', 'Radius']
+# Columns derived from FeatureName at parse time (see `parse_data.classify_feature_name`)
+feature_index_columns = ['FD_number', 'CH_channel', 'Position', 'FeatureClass']
+
 # DataParser looks for these keys in the metadata
 required_keys = ['TrayNo', 'ComponentID', 'Operator', 'Geometry', 'Density', 'Flatness', 'PositionID']
 # If the following keys are missing from the header, a warning will be raised
@@ -0,0 +1,165 @@
+import asyncio, logging, inspect
+
+_DONE = object()  # end-of-stream marker passed between stages
+
+class Stage():
+    """One step of a `Pipeline`: `concurrency` workers apply func to the items of a bounded input queue."""
+    def __init__(self, name, func, concurrency=1, queue_size=2, batch_size=1):
+        """Parameters:
+        - name (str): Stage name, used in log messages and error reports.
+        - func (callable): Called with the output of the previous stage. May be a coroutine function.
+        - concurrency (int): Number of items processed by this stage at the same time.
+        - queue_size (int): Number of finished items of the previous stage waiting for this one. Bounds the memory in flight.
+        - batch_size (int): If more than 1, func is called with a list of up to batch_size items, as many as are waiting,
+          and returns a list of their results. A result may be an exception, failing that item only. A shorter list skips
+          the remaining items, e.g. after a failure with stop_on_error."""
+        self.name = name
+        self.func = func
+        self.concurrency = max(1, int(concurrency))
+        self.queue_size = max(1, int(queue_size))
+        self.batch_size = max(1, int(batch_size))
+
+    async def apply(self, value):
+        value = self.func(value)
+        if inspect.isawaitable(value):
+            value = await value
+        return value
+
+class Pipeline():
+    """Stream items through a sequence of stages connected by bounded asyncio queues,
+    so that e.g. the upload of item N overlaps the computation of item N+1.
+
+    Items keep their input index. A failing item is recorded in `errors` and, with stop_on_error,
+    no later item enters any further stage; items before it are still finished."""
+    def __init__(self, stages: list, stop_on_error=True):
+        self.stages = stages
+        self.stop_on_error = stop_on_error
+        self.results = {}  # {index: output of the last stage}
+        self.errors = {}   # {index: (stage name, exception, input of the failed stage)}
+        self._stopping = False
+        self._feeding = False
+
+    def _skip(self, index) -> bool:
+        if self._stopping:
+            return True
+        return self.stop_on_error and bool(self.errors) and index > min(self.errors)
+
+    async def _feed(self, items, queue, workers):
+        self._feeding = True
+        try:
+            if hasattr(items, '__aiter__'):
+                index = 0
+                async for item in items:
+                    if self._skip(index):
+                        break
+                    await queue.put((index, item))
+                    index += 1
+            else:
+                for index, item in enumerate(items):
+                    if self._skip(index):
+                        break
+                    await queue.put((index, item))
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+        self._feeding = False
+        for _ in range(workers):
+            await queue.put(_DONE)
+
+    async def _work(self, stage: Stage, inbox, outbox):
+        if stage.batch_size > 1:
+            return await self._work_batches(stage, inbox, outbox)
+        while True:
+            entry = await inbox.get()
+            if entry is _DONE:
+                return
+            index, value = entry
+            if self._skip(index):
+                continue
+            try:
+                value = await stage.apply(value)
+            except Exception as e:
+                self._fail(stage, index, e, value)
+                continue
+            await self._deliver(outbox, index, value)
+
+    async def _work_batches(self, stage: Stage, inbox, outbox):
+        done = False
+        while not done:
+            entries = [await inbox.get()]
+            while len(entries) < stage.batch_size and entries[-1] is not _DONE and not inbox.empty():
+                entries.append(inbox.get_nowait())
+            if entries[-1] is _DONE:
+                done = True
+                entries.pop()
+            entries = [(index, value) for index, value in entries if not self._skip(index)]
+            if not entries:
+                continue
+            try:
+                results = await stage.apply([value for _, value in entries])
+            except Exception as e:
+                for index, value in entries:
+                    self._fail(stage, index, e, value)
+                continue
+            for (index, value), result in zip(entries, results):
+                if isinstance(result, Exception):
+                    self._fail(stage, index, result, value)
+                else:
+                    await self._deliver(outbox, index, result)
+
+    def _fail(self, stage: Stage, index, error, value):
+        logging.debug(f"Stage {stage.name} failed on item {index}: {error}")
+        self.errors[index] = (stage.name, error, value)
+
+    async def _deliver(self, outbox, index, value):
+        if outbox is None:
+            self.results[index] = value
+        else:
+            await outbox.put((index, value))
+
+    async def _run_stage(self, stage: Stage, inbox, outbox, next_workers):
+        await asyncio.gather(*(self._work(stage, inbox, outbox) for _ in range(stage.concurrency)))
+        if outbox is not None:
+            for _ in range(next_workers):
+                await outbox.put(_DONE)
+
+    async def run(self, items) -> tuple[dict, dict]:
+        """Run all items (an iterable or async iterable) through the stages and wait until every stage is drained.
+        If the run is cancelled (e.g. on Ctrl+C), it shuts down gracefully: no new item is started in any stage,
+        but the work in progress, like a database transaction, is finished first. Cancelling it again stops at once.
+
+        Return
+        - dict: {index: result} of the items that passed every stage.
+        - dict: {index: (stage name, exception, input of the failed stage)} of the items that failed,
+        e.g. to run them through the remaining stages again later."""
+        queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        tasks = [asyncio.create_task(self._feed(items, queues[0], self.stages[0].concurrency))]
+        for i, stage in enumerate(self.stages):
+            last = i == len(self.stages) - 1
+            outbox = None if last else queues[i + 1]
+            next_workers = 0 if last else self.stages[i + 1].concurrency
+            tasks.append(asyncio.create_task(self._run_stage(stage, queues[i], outbox, next_workers)))
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        except asyncio.CancelledError:
+            await self._shutdown(tasks)
+            raise
+        failed = [task for task in done if task.exception() is not None]
+        if failed:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise failed[0].exception()
+        return self.results, self.errors
+
+    async def _shutdown(self, tasks):
+        logging.warning("Stopping: finishing the items in progress...")
+        self._stopping = True
+        if self._feeding:
+            tasks[0].cancel()
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,32 +1,72 @@
 import numpy as np
 import pandas as pd
-import send2trash, yaml, os, logging
+import send2trash, yaml, os, logging, time, asyncio
 import matplotlib
 matplotlib.use('Agg')
 from src.ogp_height_plotter import PlotTool, grade, ValueMissingError, ValueRangeError
-from src.upload_inspect import DBClient
-from src.make_accuracy_plot import make_accuracy_plot
+from src.upload_inspect import DBClient, TRANSIENT_DB_ERRORS, proto_name
+from src.render_pool import RenderPool
+from src.timing import RunTimer
+from src.profiling import RunProfiler, to_thread
 from src.param import COMPONENT_PARAMS, COMP_PREFIX
+from src.parse_data import ParsedSurvey
+from src.pipeline import Pipeline, Stage
 from datetime import datetime
+from typing import NamedTuple
 
 pbase = os.path.basename
 pdir = os.path.dirname
 pjoin = os.path.join
 
+class UploadError(Exception):
+    pass
+
+# Outcomes of processing one survey file
+OK, PARSE_ERROR, GEOMETRY_ERROR, DB_ERROR = 'ok', 'parse error', 'geometry error', 'db error'
+
+class SurveyOutcome(NamedTuple):
+    """Outcome of processing and uploading one survey file."""
+    source: str       # path of the survey file
+    status: str       # OK, PARSE_ERROR, GEOMETRY_ERROR or DB_ERROR
+    reason: str = ''  # error message, for failures
+    attempts: int = 1 # upload attempts, more than one after retries
+
+def db_component_name(comp_type, component_id) -> str:
+    """Name of a surveyed component in the database. Protomodule surveys may carry the module name (ML), stored as PL."""
+    if component_id is not None and comp_type.rstrip('s') == 'protomodule':
+        return proto_name(component_id)
+    return component_id
+
 class SurveyProcessor():
     """Process Parsed OGP Survey CSV files and extract data for plotting and uploading to database."""
-    def __init__(self, OGPSurveyFilePath: list, MetaFilePath: list, yamlconfig: dict):
+    def __init__(self, OGPSurveyFilePath: list, MetaFilePath: list, yamlconfig: dict, surveys: list = None, render_pool: RenderPool = None, proto_offsets: dict = None, timer: RunTimer = None, profiler: RunProfiler = None, client: DBClient = None):
         """Initialize ImageProcessor object.
         
         Parameters:
-        - OGPSurveyFilePath (list): (list of) Paths to parsed output csvs of OGP Surveys.
-        - MetaFilePath (list): Paths to the metadata file for the OGP Survey files."""
+        - OGPSurveyFilePath (list): (list of) Paths to parsed outputs (npz or csv) of OGP Surveys.
+        - MetaFilePath (list): Paths to the metadata file for the OGP Survey files. Same as OGPSurveyFilePath for npz outputs.
+        - surveys (iterable of ParsedSurvey): Surveys handed over in memory by `DataParser.iter_surveys`, processed after the files.
+          May be a generator, which is then consumed while the previous surveys are processed.
+        - render_pool (RenderPool): Worker processes rendering the plots, shared between processors. One is started for this processor if not given.
+        - proto_offsets (dict): {upper case protomodule name (see `proto_name`): (x_offset_mu, y_offset_mu, ang_offset_deg)} of the protomodules uploaded in this run,
+          shared between processors. Modules look up their protomodule here before querying the database.
+        - timer (RunTimer): Collects the time spent in each step for the run report. A new one if not given.
+        - profiler (RunProfiler): Profiles the pipeline stages, with `--profile`.
+        - client (DBClient): Database client, shared between processors so that they share its connection pool.
+          One is opened for this processor if not given, and closed at the end of `process_and_upload`."""
         self.OGPSurveyFile = OGPSurveyFilePath
         self.MetaFile = MetaFilePath
+        self.surveys = surveys if surveys is not None else []
+        self.timings = {}  # {survey source: seconds spent processing and uploading it}
+        self.sources = []  # survey sources, in the order they entered the pipeline
+        self.outcomes = {}  # {survey source: SurveyOutcome}
+        self.proto_offsets = proto_offsets if proto_offsets is not None else {}
+        self.timer = timer if timer is not None else RunTimer()
+        self.profiler = profiler
 
         for i, file in enumerate(self.OGPSurveyFile):
-            if not file.endswith('.csv'):
-                raise ValueError('Parsed OGP result must be a csv file.')
+            if not file.endswith(('.npz', '.csv')):
+                raise ValueError('Parsed OGP result must be a npz or csv file.')
             self.OGPSurveyFile[i] = file.replace('\\', '/')
         
         im_dir = yamlconfig.get('ogp_image_dir')
@@ -36,7 +76,13 @@ class SurveyProcessor():
         self.tray_dir = yamlconfig.get('ogp_tray_dir')
         logging.debug(f"Using tray files from directory: {self.tray_dir}")
 
-        self.client = DBClient(yamlconfig)
+        self.config = yamlconfig
+        self.continue_on_error = yamlconfig.get('continue_on_error', False)
+        self.upload_retries = yamlconfig.get('upload_retries', 3)
+        self._own_client = client is None
+        self.client = DBClient(yamlconfig) if self._own_client else client
+        self._own_pool = render_pool is None
+        self.render_pool = RenderPool(yamlconfig.get('render_workers', 2), profiler) if self._own_pool else render_pool
         pass
 
     async def __call__(self, component_type) -> tuple[bool, int]:
@@ -44,26 +90,43 @@ class SurveyProcessor():
         status, index = await self.process_and_upload(component_type)
         return status, index
  
-    async def __getArgs__(self, ex_file, meta_file, comp_type):
-        """Get arguments for uploading to database, including the necessary meta data to upload and the image bytes.
+    def iter_surveys(self):
+        """Yield the `ParsedSurvey`s to process. Parsed output files are loaded one at a time."""
+        for ex_file, meta_file in zip(self.OGPSurveyFile, self.MetaFile):
+            yield ParsedSurvey.load(ex_file, meta_file)
+        yield from self.surveys
+
+    async def aiter_surveys(self):
+        """Pull the surveys from `iter_surveys` in a worker thread, so that loading or parsing the next survey
+        overlaps the processing of the previous ones."""
+        surveys = self.iter_surveys()
+        while True:
+            survey = await to_thread(self.profiler, next, surveys, None)
+            if survey is None:
+                return
+            self.sources.append(survey.source)
+            yield survey
+
+    def compute(self, survey: ParsedSurvey, comp_type) -> dict:
+        """Calculate the offsets and the data to upload for one survey, without rendering any plot. Runs in a worker thread.
         
         Return 
-        - db_upload (dict): Dictionary of data to upload to database.
-        - component_params (dict): Dictionary of parameters for the component type.
-        - comp_type (str): Component folder name."""
-        with open(meta_file, 'r') as f:
-            metadata = yaml.safe_load(f)
+        - dict: Job passed on to `render` and `upload`, holding
+            - db_upload (dict): Dictionary of data to upload to database, still without the images.
+            - component_params (dict): Dictionary of parameters for the component type.
+            - compID (str): Component name.
+            - plotter (PlotTool), im_args (dict), offsets (tuple): Inputs of the plots."""
+        start = time.perf_counter()
+        # Copy, since the survey may still be written to disk in the background
+        metadata = dict(survey.header)
+        df = survey.features
         
         singular_type = comp_type.rstrip('s')
-        compID = metadata['ComponentID']
-
-        if singular_type == 'protomodule': 
-            compID = compID.replace('ML', 'PL', 1)
-            metadata['ComponentID'] = compID
+        compID = db_component_name(comp_type, metadata['ComponentID'])
+        metadata['ComponentID'] = compID
             
-        df = pd.read_csv(ex_file)
         plotter = PlotTool(metadata, comp_type, df, self.tray_dir, pjoin(self.im_dir, comp_type))
-        filesuffix = pbase(ex_file).split('.')[0]
+        filesuffix = survey.name
 
         logging.info("=" * 100)
         logging.info(f"###### Calculating offsets for {comp_type} {compID} #######")
@@ -72,6 +135,7 @@ class SurveyProcessor():
         component_params = COMPONENT_PARAMS[singular_type]
         name_field = f'{COMP_PREFIX[singular_type]}_name'
         db_upload = {name_field: compID}
+        offsets = None
 
         if singular_type == 'baseplate' or singular_type == 'hexaboard':
             Offset = metadata.get("Thickness_Offset", 0)
@@ -93,7 +157,8 @@ class SurveyProcessor():
             db_upload.update({'flatness': np.round(metadata['Flatness'], 3), 'thickness': np.round(report_thick, 3), 
                              'avg_thickness': report_thick, 'grade': 'A', 'max_thickness': max_thickness})
         elif singular_type == 'protomodule' or singular_type == 'module':
-            XOffset, YOffset, AngleOff = plotter.get_offsets()
+            XOffset, YOffset, AngleOff = plotter.get_offsets(plot=False)
+            offsets = (XOffset, YOffset, AngleOff)
             report_thick = metadata.get("Thickness", None)
             if report_thick is None:
                 logging.warning(f"No Thickness value found in metadata for {compID}. Using average thickness from OGP data: {report_thick}")
@@ -106,36 +171,159 @@ class SurveyProcessor():
             db_upload.update({'x_offset_mu':np.round(XOffset*1000), 'y_offset_mu':np.round(YOffset*1000), 'ang_offset_deg':np.round(AngleOff,3),
                               "weight_grams": metadata.get('Weight', None), 'max_thickness': np.round(np.max(plotter.z_points),3), "flatness": np.round(metadata['Flatness'],3),
                              'avg_thickness': report_thick, 'grade': grade((XOffset, YOffset), AngleOff)})
-            if singular_type == 'module':
-                PMoffsets = await self.client.GrabSensorOffsets(compID)
-                SensorXOffset, SensorYOffset, SensorAngleOff = PMoffsets
-                PCBXOffset, PCBYOffset, PCBAngleOff = int(XOffset*1000), int(YOffset*1000), AngleOff
-            else:
-                PCBXOffset, PCBYOffset, PCBAngleOff = 0, 0, 0 
-                SensorXOffset, SensorYOffset, SensorAngleOff = int(XOffset*1000), int(YOffset*1000), AngleOff
-            logging.debug(f"Making Accuracy Plot With Sensor Offsets {SensorXOffset}, {SensorYOffset}, {SensorAngleOff}")
-            acc_bytes = make_accuracy_plot(compID, pjoin(self.im_dir, comp_type), SensorXOffset, SensorYOffset, SensorAngleOff, PCBXOffset, PCBYOffset, PCBAngleOff)
-            db_upload.update({"offsetplot": acc_bytes})
         else:
             raise ValueError("Component type not recognized. Supporting only baseplate, hexaboard, protomodule, and module.")
 
         im_args = {"vmini":component_params['vmini'], "vmaxi":component_params['vmaxi'], 
                    "new_angle": component_params['new_angle'], "savename": pjoin(self.im_dir, comp_type, f"{filesuffix}_heights"),
                    "mod_flat": metadata['Flatness'], "title": metadata['ComponentID'], "show_plot": False}
-        
-        logging.debug(f"###### Generating Image for {compID} #######")
-        
-        im_bytes = plotter(**im_args)
 
         db_upload.update({'x_points':(plotter.x_points).tolist(), 'y_points':(plotter.y_points).tolist(), 
-            'z_points':(plotter.z_points).tolist(),'hexplot':im_bytes, 'inspector': metadata['Operator'], 'comment':metadata.get("Comment", None)})
+            'z_points':(plotter.z_points).tolist(), 'inspector': metadata['Operator'], 'comment':metadata.get("Comment", None)})
         
         db_upload.update(self.getDateTime(metadata))
 
-        return db_upload, component_params, compID  
+        return {'source': survey.source, 'start': start, 'comp_type': comp_type, 'compID': compID, 'db_upload': db_upload,
+                'component_params': component_params, 'plotter': plotter, 'im_args': im_args, 'offsets': offsets}
+
+    async def compute_stage(self, survey: ParsedSurvey, comp_type) -> dict:
+        """`compute` in a worker thread, then look up the protomodule offsets of modules in the database."""
+        compute = self.compute if self.profiler is None else self.profiler.wrap('compute', self.compute)
+        job = await to_thread(self.profiler, compute, survey, comp_type)
+        self.timer.add_many(job['source'], job['plotter'].timings)
+        if comp_type.rstrip('s') == 'module':
+            job['pm_offsets'] = await self.sensor_offsets(job['compID'])
+        return job
+
+    async def sensor_offsets(self, module_name) -> tuple:
+        """Offsets of the protomodule of a module: from the protomodules uploaded in this run, else from the database."""
+        offsets = self.proto_offsets.get(proto_name(module_name).upper())
+        if offsets is not None:
+            logging.debug(f"Using protomodule offsets of this run for {module_name}: {offsets}")
+            return offsets
+        return await self.client.GrabSensorOffsets(module_name)
+
+    async def render(self, job: dict) -> dict:
+        """Render the plots of a computed job in the render worker processes and add the image bytes to its upload data."""
+        plotter, compID, comp_type = job['plotter'], job['compID'], job['comp_type']
+        renders, timings = {}, {}
+        if job['offsets'] is not None:
+            XOffset, YOffset, AngleOff = job['offsets']
+            if 'pm_offsets' in job:
+                SensorXOffset, SensorYOffset, SensorAngleOff = job['pm_offsets']
+                PCBXOffset, PCBYOffset, PCBAngleOff = int(XOffset*1000), int(YOffset*1000), AngleOff
+            else:
+                PCBXOffset, PCBYOffset, PCBAngleOff = 0, 0, 0 
+                SensorXOffset, SensorYOffset, SensorAngleOff = int(XOffset*1000), int(YOffset*1000), AngleOff
+            logging.debug(f"Making Accuracy Plot With Sensor Offsets {SensorXOffset}, {SensorYOffset}, {SensorAngleOff}")
+            renders['FDpoints'] = self.render_pool.fiducials(plotter, timings=timings)
+            renders['offsetplot'] = self.render_pool.accuracy(compID, pjoin(self.im_dir, comp_type), SensorXOffset, SensorYOffset, SensorAngleOff, PCBXOffset, PCBYOffset, PCBAngleOff, timings=timings)
+
+        logging.debug(f"###### Generating Image for {compID} #######")
+        renders['hexplot'] = self.render_pool.heights(plotter, job['im_args'], timings=timings)
+        images = dict(zip(renders, await asyncio.gather(*renders.values())))
+        self.timer.add_many(job['source'], timings)
+        images.pop('FDpoints', None)  # only saved to the image directory
+        job['db_upload'].update(images)
+        return job
+
+    async def upload(self, job: dict) -> str:
+        """Upload a rendered job to the database. Raise UploadError if the database rejects it."""
+        self.print_db_msg(job['comp_type'], job['compID'])
+        timings = {}
+        try:
+            status = await self.client.link_and_update_table(job['component_params'], job['db_upload'], timings)
+        finally:
+            self.timer.add_many(job['source'], timings)
+        self.timings[job['source']] = time.perf_counter() - job['start']
+        if status == False:
+            raise UploadError(f"Failed to upload {job['compID']}")
+        return self.uploaded(job)
+
+    async def upload_batch(self, jobs: list) -> list:
+        """Upload rendered jobs together with `DBClient.upload_batch`, in one transaction per component type.
+        If a batch fails for another reason than a transient database error, its jobs are uploaded one by one,
+        so that only the failing ones fail (and, without `continue_on_error`, the ones after them are skipped).
+
+        Return
+        - list: Result of each job (see `upload`), or the exception it failed with."""
+        if len(jobs) == 1:
+            return [await self.upload(jobs[0])]
+        results = {}
+        for comp_type in dict.fromkeys(job['comp_type'] for job in jobs):
+            batch = [job for job in jobs if job['comp_type'] == comp_type]
+            for job in batch:
+                self.print_db_msg(comp_type, job['compID'])
+            timings = {}
+            try:
+                await self.client.upload_batch(batch[0]['component_params'], [job['db_upload'] for job in batch], timings)
+            except TRANSIENT_DB_ERRORS:
+                raise
+            except Exception as e:
+                logging.warning(f"Failed to upload {len(batch)} {comp_type} together ({e}), uploading them one by one.")
+                for job in batch:
+                    results[id(job)] = await self._upload_or_error(job)
+                    if isinstance(results[id(job)], Exception) and not self.continue_on_error:
+                        break
+                continue
+            for job in batch:
+                # the batch takes one round trip; each job gets its share of the time
+                self.timer.add_many(job['source'], {stage: seconds / len(batch) for stage, seconds in timings.items()})
+                self.timings[job['source']] = time.perf_counter() - job['start']
+                results[id(job)] = self.uploaded(job)
+        ordered = []
+        for job in jobs:
+            if id(job) not in results:
+                break  # skipped after a failure
+            ordered.append(results[id(job)])
+            if isinstance(ordered[-1], Exception) and not self.continue_on_error:
+                break
+        return ordered
+
+    async def _upload_or_error(self, job: dict):
+        try:
+            return await self.upload(job)
+        except Exception as e:
+            return e
+
+    def uploaded(self, job: dict) -> str:
+        """Record a job uploaded to the database. Return its source."""
+        self.timer.add(job['source'], 'process', self.timings[job['source']])
+        if job['comp_type'].rstrip('s') == 'protomodule':
+            db_upload = job['db_upload']
+            self.proto_offsets[proto_name(job['compID']).upper()] = (db_upload['x_offset_mu'], db_upload['y_offset_mu'], db_upload['ang_offset_deg'])
+        return job['source']
+
+    def stage(self, name, func, concurrency, batch_size=1) -> Stage:
+        """Pipeline stage applying the coroutine function func, profiled as stage name if a profiler is set.
+        A batch stage gets a queue that can hold a whole batch."""
+        if self.profiler is not None:
+            plain = func
+            func = lambda value: self.profiler.coroutine(name, plain(value))
+        queue_size = max(self.config.get('pipeline_queue_size', 2), batch_size)
+        return Stage(name, func, concurrency, queue_size, batch_size=batch_size)
+
+    def upload_stage(self) -> Stage:
+        """Upload stage. With `upload_batch_size` above 1, up to that many surveys waiting for upload are uploaded together."""
+        batch_size = self.config.get('upload_batch_size', 50)
+        if batch_size > 1:
+            return self.stage('upload', self.upload_batch, self.config.get('upload_workers', 1), batch_size)
+        return self.stage('upload', self.upload, self.config.get('upload_workers', 1))
+
+    def pipeline(self, comp_type) -> Pipeline:
+        """Stages compute -> render -> upload, fed by `aiter_surveys`. The upload of one survey overlaps the
+        computation and rendering of the next ones; stage concurrency and queue sizes come from the config."""
+        return Pipeline([
+            self.stage('compute', lambda survey: self.compute_stage(survey, comp_type), self.config.get('compute_workers', 1)),
+            self.stage('render', self.render, self.render_pool.workers),
+            self.upload_stage()], stop_on_error=not self.continue_on_error)
     
     async def process_and_upload(self, comp_type) -> tuple[bool, int]:
-        """Process all OGP Survey files and upload to database.
+        """Process all OGP Survey files and upload to database. The outcome of each file is recorded in `self.outcomes`.
+
+        By default the batch stops at the first failing file. With `continue_on_error` every file is processed,
+        and uploads that failed with a transient database error (see `TRANSIENT_DB_ERRORS`) are retried at the end
+        of the batch, up to `upload_retries` times with exponential backoff starting at `retry_backoff_seconds`.
         
         Parameters:
         - `comp_type` (str): Type of component to process.
@@ -143,27 +331,69 @@ class SurveyProcessor():
         Returns:
         - tuple[bool, int]: 
             - bool: True if all files were successfully uploaded, False if any file fails
-            - int: Index of the last successfully processed file (-1 if no files were processed)"""
+            - int: Index of the last successfully processed file before the first failure (-1 if none)"""
+        try:
+            results, errors = await self.pipeline(comp_type).run(self.aiter_surveys())
+            for index in results:
+                self.outcomes[self.sources[index]] = SurveyOutcome(self.sources[index], OK)
+            retry = {}
+            for index, (stage, error, value) in sorted(errors.items()):
+                if self.continue_on_error and self.upload_retries > 0 and stage == 'upload' and isinstance(error, TRANSIENT_DB_ERRORS):
+                    retry[self.sources[index]] = value
+                else:
+                    self.record_failure(self.sources[index], stage, error)
+            if retry:
+                await self.retry_uploads(retry)
+        finally:
+            if self._own_pool:
+                self.render_pool.close()
+            if self._own_client:
+                await self.client.close()
+
         last_successful_index = -1
-        for idx, (ex_file, meta_file) in enumerate(zip(self.OGPSurveyFile, self.MetaFile)):
-            try: 
-                db_upload, comp_params, compID = await self.__getArgs__(ex_file, meta_file, comp_type)
-            except ValueMissingError as e:
-                logging.error(f"Error in {ex_file}: {e}")
-                return False, last_successful_index
-            except ValueRangeError as e:
-                logging.error(f"Error in {ex_file}: {e}")
-                return False, last_successful_index
-            self.print_db_msg(comp_type, compID)
-            status = await self.client.link_and_update_table(comp_params, db_upload)
-            # status = await self.client.upload_PostgreSQL(comp_params, db_upload)
-            if status == False:
-                logging.error("No more uploading will be done due to the error. Please double check the data and try again.")
-                return False, last_successful_index
-            last_successful_index = idx
-        return True, last_successful_index  # Return True and last index if all files were processed successfully
-                # send2trash.send2trash(ex_file)
-            # print(f'Moved {ex_file} to recycle bin.')
+        for source in self.sources:
+            if source not in self.outcomes or self.outcomes[source].status != OK:
+                break
+            last_successful_index += 1
+        if errors and not self.continue_on_error:
+            logging.error("No more uploading will be done due to the error. Please double check the data and try again.")
+        status = all(outcome.status == OK for outcome in self.outcomes.values()) and len(self.outcomes) == len(self.sources)
+        return status, last_successful_index
+
+    def record_failure(self, source, stage, error, attempts=1):
+        """Record the outcome of a survey that failed in the given pipeline stage."""
+        if stage != 'upload' and not self.continue_on_error and not isinstance(error, (ValueMissingError, ValueRangeError)):
+            raise error  # unexpected errors end the run, unless continue_on_error is set
+        status = DB_ERROR if stage == 'upload' else GEOMETRY_ERROR
+        reason = str(error) if isinstance(error, (ValueMissingError, ValueRangeError, UploadError)) else f"{type(error).__name__}: {error}"
+        logging.error(f"Error in {source}: {reason}")
+        self.outcomes[source] = SurveyOutcome(source, status, reason, attempts)
+
+    async def retry_uploads(self, jobs: dict):
+        """Retry uploads that failed with transient database errors, with exponential backoff.
+
+        Parameters:
+        - jobs (dict): {survey source: rendered job} to upload again."""
+        retries = self.upload_retries
+        delay = self.config.get('retry_backoff_seconds', 2)
+        for attempt in range(2, retries + 2):
+            logging.warning(f"Retrying {len(jobs)} uploads in {delay} seconds (attempt {attempt} of {retries + 1})...")
+            await asyncio.sleep(delay)
+            sources = list(jobs)
+            for source in sources:
+                self.timer.start(source)
+            results, errors = await Pipeline([self.upload_stage()], stop_on_error=False).run(jobs.values())
+            jobs = {}
+            for index in results:
+                self.outcomes[sources[index]] = SurveyOutcome(sources[index], OK, '', attempt)
+            for index, (stage, error, value) in errors.items():
+                if isinstance(error, TRANSIENT_DB_ERRORS) and attempt <= retries:
+                    jobs[sources[index]] = value
+                else:
+                    self.record_failure(sources[index], stage, error, attempt)
+            if not jobs:
+                return
+            delay *= 2
         
     @staticmethod
     def print_db_msg(comp_type, modname):
@@ -0,0 +1,283 @@
+import os, sys, asyncio, cProfile, pstats, logging, threading, tracemalloc, types
+from contextlib import contextmanager
+from datetime import datetime
+from rich.console import Console
+from rich.table import Table
+
+# From Python 3.12 on, cProfile is built on sys.monitoring: only one profiler can be active in a process,
+# and it records the calls of every thread, not only of the one that enabled it.
+ONE_PROFILER = sys.version_info >= (3, 12)
+
+def release_inherited_profiler():
+    """Stop the profiler a worker process inherits when it is forked from a profiled thread, so that it neither
+    slows the worker down nor keeps the worker from starting profiles of its own. Used as a process pool initializer."""
+    if ONE_PROFILER:
+        tool = sys.monitoring.PROFILER_ID
+        if sys.monitoring.get_tool(tool) is not None:
+            sys.monitoring.set_events(tool, sys.monitoring.events.NO_EVENTS)
+            sys.monitoring.free_tool_id(tool)
+    else:
+        sys.setprofile(None)
+
+async def to_thread(profiler, func, *args):
+    """`asyncio.to_thread(func, *args)`, except when profiler runs threaded work inline (see `RunProfiler`):
+    then func runs in the calling thread, blocking the event loop, so that its calls are counted in the right stage."""
+    if profiler is not None and profiler.inline:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+class _RawStats():
+    """Load a raw stats dict (see `raw_stats`), e.g. sent back by a worker process, into `pstats.Stats`."""
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def raw_stats(profile: cProfile.Profile) -> dict:
+    """Picklable stats of a finished profile: {(file, line, function): (calls, primitive calls, self time, cumulative time, callers)}."""
+    profile.create_stats()
+    return profile.stats
+
+def frame_label(func) -> str:
+    filename, line, name = func
+    if filename == '~':  # built-in function
+        return name.replace(';', ':')
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(';', ':')
+
+def collapsed_stacks(stats: pstats.Stats, max_depth=64, min_fraction=1e-4) -> dict:
+    """Approximate call stacks of a profile, for flame graph tools (flamegraph.pl, speedscope, inferno).
+
+    cProfile only records caller -> callee pairs, so the time of a function called from several places is split
+    among its callers in proportion to the cumulative time of each call pair. Time not covered by the callers, e.g.
+    of a function that was running when its profile was resumed, starts a stack of its own. Recursive calls are
+    folded into the first occurrence of the function on the stack. The callees of a frame never take more than its
+    time, so the stacks add up to at most the profiled time; time the call pairs do not account for is left out.
+
+    Return
+    - dict: {"root;caller;function": self time in microseconds}."""
+    callees, roots = {}, {}
+    for func, (_, _, _, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge[3] if isinstance(edge, tuple) else 0.0
+        roots[func] = ct - sum(callees[caller][func] for caller in callers)
+    min_seconds = max(stats.total_tt, 1e-9) * min_fraction
+    stacks = {}
+
+    def walk(func, path, seconds):
+        _, _, tt, ct, _ = stats.stats[func]
+        share = seconds / ct if ct > 0 else 0.0
+        self_seconds = tt * share
+        children = {callee: edge_seconds * share for callee, edge_seconds in callees.get(func, {}).items() if callee in stats.stats}
+        # recursion counts the same time in several call pairs; the callees cannot take more than this frame's time,
+        # which also keeps the number of stacks above min_seconds bounded
+        budget, total = max(seconds - self_seconds, 0.0), sum(children.values())
+        scale = budget / total if total > budget else 1.0
+        for callee, child_seconds in children.items():
+            child_seconds *= scale
+            if callee in path or len(path) >= max_depth or child_seconds < min_seconds:
+                self_seconds += child_seconds  # folded into this frame
+            else:
+                walk(callee, path + (callee,), child_seconds)
+        key = ';'.join(frame_label(frame) for frame in path)
+        stacks[key] = stacks.get(key, 0) + self_seconds * 1e6
+
+    for root, seconds in roots.items():
+        if seconds >= min_seconds:
+            walk(root, (root,), seconds)
+    return {stack: int(round(value)) for stack, value in stacks.items() if value >= 1}
+
+@types.coroutine
+def _stepped(coro, step):
+    """Drive coro like `await coro` does, running each of its steps (up to the next suspension) inside step()."""
+    value, error = None, None
+    while True:
+        with step():
+            try:
+                yielded = coro.send(value) if error is None else coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+        try:
+            value, error = (yield yielded), None
+        except BaseException as e:
+            value, error = None, e
+
+class RunProfiler():
+    """Profile a run with cProfile, per processing stage (parse, compute, render, upload), and optionally trace
+    the peak memory allocated in each stage with tracemalloc.
+
+    cProfile follows a single thread, so every stage is profiled in the thread or worker process it runs in and the
+    profiles are merged per stage. The work of the main thread outside the stages is profiled as the 'main' stage;
+    the whole run is the merge of all stages. With overlapping stages, a memory peak includes the allocations of the
+    stages running at the same time in the same process.
+
+    From Python 3.12 on, only one profiler can be active per process, and it sees every thread (see `ONE_PROFILER`).
+    The work the stages would hand to threads (see `to_thread`) then runs inline in the event loop thread instead,
+    where each stage pauses the profile of the stage it interrupts. This serializes parsing and computing with the
+    rest of the run while profiling. Python code of other threads, e.g. of the process pools, is counted in the
+    stage active at the time."""
+    def __init__(self, trace_memory=False, inline=ONE_PROFILER):
+        """Parameters:
+        - trace_memory (bool): Record the peak allocations per stage (slows down the run).
+        - inline (bool): Run the threaded work of the stages in the calling thread (see `to_thread`)."""
+        self.trace_memory = trace_memory
+        self.inline = inline
+        self.unprofiled = set()  # stages whose profile could not be enabled, at least once
+        self.started = datetime.now()
+        self.stats = {}   # {stage: pstats.Stats} of the worker processes
+        self.memory = {}  # {stage: peak allocated bytes}
+        self._profiles = []  # [(stage, cProfile.Profile)], one per thread and stage, merged when written
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._warned = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _profile(self, stage) -> cProfile.Profile:
+        """The profile of stage in the calling thread, which accumulates while it is enabled again and again."""
+        if not hasattr(self._local, 'profiles'):
+            self._local.profiles = {}
+        if stage not in self._local.profiles:
+            self._local.profiles[stage] = cProfile.Profile()
+            with self._lock:
+                self._profiles.append((stage, self._local.profiles[stage]))
+        return self._local.profiles[stage]
+
+    def add_stats(self, stage, stats: dict):
+        """Merge raw stats (see `raw_stats`) into the profile of stage."""
+        if not stats:
+            return
+        with self._lock:
+            if stage in self.stats:
+                self.stats[stage].add(_RawStats(stats))
+            else:
+                self.stats[stage] = pstats.Stats(_RawStats(stats))
+
+    def add_memory(self, stage, peak):
+        with self._lock:
+            self.memory[stage] = max(self.memory.get(stage, 0), peak)
+
+    @contextmanager
+    def stage(self, name, trace_memory=True):
+        """Profile the body of a with block as stage name, in the calling thread. A stage entered inside another
+        one pauses the outer profile, so that each call is counted in one stage only. Stages record their memory
+        peak unless trace_memory is False, e.g. for an outer stage whose peak is reset by the inner ones."""
+        stack = self._stack()
+        memory_start = self._memory_start() if trace_memory else None
+        profile = self._profile(name)
+        if stack:
+            stack[-1].disable()
+        try:
+            profile.enable()
+        except ValueError as e:  # another profiler is active, e.g. one of another thread on Python >= 3.12
+            with self._lock:
+                self.unprofiled.add(name)
+            if not self._warned:
+                logging.warning(f"Some {name} calls are not profiled: {e}")
+                self._warned = True
+            profile = None
+        if profile is not None:
+            stack.append(profile)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                stack.pop()
+            if memory_start is not None:
+                self.add_memory(name, tracemalloc.get_traced_memory()[1] - memory_start)
+            if stack:
+                stack[-1].enable()
+
+    def _memory_start(self):
+        if not self.trace_memory:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        self.add_memory('run', peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def wrap(self, name, func):
+        """Return func profiled as stage name in the thread calling it."""
+        def profiled(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return profiled
+
+    def iterate(self, name, items):
+        """Iterate over items, profiling the production of each item as stage name."""
+        items = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    async def coroutine(self, name, coro):
+        """Await coro, profiling each of its steps as stage name. The time it waits, e.g. for the database, is not
+        counted; the other tasks of the event loop running meanwhile are not counted in it either."""
+        return await _stepped(coro, lambda: self.stage(name))
+
+    def profiles(self) -> dict:
+        """Return {stage: pstats.Stats}, with the merge of all stages as 'run'."""
+        for stage, profile in self._profiles:
+            self.add_stats(stage, raw_stats(profile))
+        self._profiles = []
+        profiles = dict(self.stats)
+        if profiles:
+            first, *others = self.stats.values()
+            run = pstats.Stats(_RawStats(dict(first.stats)))
+            run.add(*others)
+            profiles['run'] = run
+        return profiles
+
+    def write(self, out_dir) -> list:
+        """Write name.pstats (for pstats or snakeviz) and name.collapsed (for flame graph tools) for every stage
+        and for the whole run ('run'), plus memory.txt with the peak allocations per stage if traced.
+
+        Return
+        - list: Paths of the written files."""
+        if self.unprofiled:
+            logging.error(f"The profiles are incomplete: some calls of these stages could not be profiled, because another "
+                          f"profiler was active: {', '.join(sorted(self.unprofiled))}. On Python >= 3.12 they are counted "
+                          f"in the stage of that profiler instead, e.g. main.")
+        os.makedirs(out_dir, exist_ok=True)
+        if self.trace_memory:
+            self.add_memory('run', tracemalloc.get_traced_memory()[1])
+        paths = []
+        for name, stats in self.profiles().items():
+            pstats_path, collapsed_path = os.path.join(out_dir, f"{name}.pstats"), os.path.join(out_dir, f"{name}.collapsed")
+            stats.dump_stats(pstats_path)
+            with open(collapsed_path, 'w') as f:
+                for stack, micros in sorted(collapsed_stacks(stats).items()):
+                    f.write(f"{stack} {micros}\n")
+            paths += [pstats_path, collapsed_path]
+        if self.memory:
+            memory_path = os.path.join(out_dir, 'memory.txt')
+            with open(memory_path, 'w') as f:
+                f.write(f"{'stage':<12}{'peak MiB':>12}\n")
+                for name, peak in self.memory.items():
+                    f.write(f"{name:<12}{peak / 2**20:>12.1f}\n")
+            paths.append(memory_path)
+        return paths
+
+    def print_summary(self, out_dir):
+        """Print the profiled time (including waits, e.g. of the event loop in main) and peak memory per stage."""
+        profiles = self.profiles()
+        table = Table(title=f"Profile ({out_dir})", show_header=True, header_style="bold magenta")
+        for column in ["Stage", "Calls", "Seconds"] + (["Peak MiB"] if self.memory else []):
+            table.add_column(column, justify="left" if column == "Stage" else "right")
+        for name in [*sorted((set(profiles) | set(self.memory)) - {'run'}), 'run']:
+            stats = profiles.get(name)
+            row = [name, str(stats.total_calls) if stats else '', f"{stats.total_tt:.3f}" if stats else '']
+            if self.memory:
+                row.append(f"{self.memory[name] / 2**20:.1f}" if name in self.memory else '')
+            table.add_row(*row)
+        Console().print(table)
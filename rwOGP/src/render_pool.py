@@ -0,0 +1,119 @@
+import asyncio, logging, time, cProfile, tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib.pyplot as plt
+from src.ogp_height_plotter import PlotTool, plotFD
+from src.make_accuracy_plot import make_accuracy_plot
+from src.profiling import raw_stats, release_inherited_profiler
+
+def _init_worker():
+    """Configure matplotlib once per worker process. Importing this module already imported pyplot and the plot settings."""
+    release_inherited_profiler()
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _ready():
+    return True
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def _profiled(func, trace_memory, *args):
+    """`_timed` under cProfile, and tracemalloc if trace_memory. Also return the raw profile stats and the peak allocated bytes."""
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result, seconds = _timed(func, *args)
+    finally:
+        profile.disable()
+    peak = tracemalloc.get_traced_memory()[1] - memory_start if trace_memory else None
+    return result, seconds, raw_stats(profile), peak
+
+def render_heights(x, y, z, centerxy, im_args: dict) -> bytes:
+    """Render the 2D height map (see `PlotTool.plot2d`). Return the PNG bytes, also saved to im_args['savename']."""
+    with plt.rc_context():
+        return PlotTool.plot2d(x, y, z, centerxy, **im_args)
+
+def render_fiducials(FD_points, hole_xy, slot_xy, save_name) -> bytes:
+    """Render the fiducial points and tray pins (see `plotFD`). Return the PNG bytes, also saved to save_name."""
+    with plt.rc_context():
+        plotFD(FD_points, hole_xy, slot_xy, True, save_name)
+    with open(save_name, 'rb') as f:
+        return f.read()
+
+def render_accuracy(*args) -> bytes:
+    """Render the accuracy plot (see `make_accuracy_plot`, which takes the same arguments). Return the PNG bytes."""
+    # make_accuracy_plot changes the global font sizes; keep them from leaking into the next job of this worker
+    with plt.rc_context():
+        return make_accuracy_plot(*args)
+
+class RenderPool():
+    """Pool of worker processes rendering the plots of processed surveys.
+
+    pyplot keeps global state, so plots cannot be rendered in parallel threads. Each worker process has its own
+    matplotlib (Agg backend), imported once when the process starts. Jobs take plain arrays and parameters and
+    return PNG bytes, and are awaited without blocking the event loop."""
+    def __init__(self, workers=2, profiler=None):
+        """Parameters:
+        - workers (int): Number of worker processes.
+        - profiler (RunProfiler): If given, the jobs are profiled in the workers and merged into its 'render' stage."""
+        self.workers = max(1, int(workers))
+        self.profiler = profiler
+        self._executor = None
+
+    def start(self):
+        """Start the worker processes now rather than on the first render."""
+        if self._executor is None:
+            logging.debug(f"Starting {self.workers} render worker processes")
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            for _ in range(self.workers):
+                self._executor.submit(_ready)
+        return self
+
+    async def submit(self, func, *args, timings: dict = None, stage=None):
+        """Run func(*args) in a worker process and return its result.
+        If timings is given, the time spent in the worker is added to it as timings[stage]."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        if self.profiler is None:
+            result, seconds = await loop.run_in_executor(self._executor, _timed, func, *args)
+        else:
+            result, seconds, stats, peak = await loop.run_in_executor(self._executor, _profiled, func, self.profiler.trace_memory, *args)
+            self.profiler.add_stats('render', stats)
+            if peak is not None:
+                self.profiler.add_memory('render', peak)
+        if timings is not None:
+            timings[stage] = seconds
+        return result
+
+    async def heights(self, plotter: PlotTool, im_args: dict, timings: dict = None) -> bytes:
+        """Render the height map of a PlotTool's points."""
+        x, y, z = (np.asarray(points, dtype=float) for points in (plotter.x_points, plotter.y_points, plotter.z_points))
+        return await self.submit(render_heights, x, y, z, plotter.get_center(), im_args, timings=timings, stage='render_heights')
+
+    async def fiducials(self, plotter: PlotTool, timings: dict = None) -> bytes:
+        """Render the fiducial plot of a PlotTool, after `PlotTool.get_offsets`."""
+        hole_xy, slot_xy = plotter.pin_xy
+        return await self.submit(render_fiducials, np.asarray(plotter.FD_points), hole_xy, slot_xy, plotter.FD_plot_path(),
+                                 timings=timings, stage='render_fd')
+
+    async def accuracy(self, *args, timings: dict = None) -> bytes:
+        return await self.submit(render_accuracy, *args, timings=timings, stage='render_accuracy')
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
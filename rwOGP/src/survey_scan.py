@@ -0,0 +1,161 @@
+import os, time, hashlib, logging
+from .inventory_store import TRACKED_STATES
+
+# Directory mtimes this close to the scan time are not trusted: a file created within
+# the same timestamp tick would not change the mtime again, so such directories are rescanned.
+RACY_SECONDS = 2.0
+
+def is_survey_file(name) -> bool:
+    return name.endswith('.txt') and not name.startswith('.')
+
+def list_survey_files(subdir_path) -> dict:
+    """List the survey files of one subdirectory with os.scandir.
+
+    Return
+    - dict: {filename: (size, mtime)}, from the stat results of the directory listing."""
+    files = {}
+    with os.scandir(subdir_path) as entries:
+        for entry in entries:
+            if is_survey_file(entry.name) and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime)
+    return files
+
+def file_hash(path, block_size=1 << 20) -> str:
+    """SHA-256 hex digest of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def compare_fingerprints(subdir_path, files: dict, known: dict) -> tuple[dict, list]:
+    """Compare the size and mtime of listed files to their inventory fingerprints.
+    The content hash is only computed for files whose size or mtime changed, to tell edited files from touched ones.
+
+    Parameters:
+    - files (dict): {filename: (size, mtime)} found on disk.
+    - known (dict): {filename: (size, mtime, hash, upload_status)} from `InventoryStore.fingerprints`.
+
+    Return
+    - dict: {filename: fields} to update in the inventory.
+    - list: Names of processed files whose contents changed. They are reset to pending."""
+    updated, modified = {}, []
+    for filename, (size, mtime) in files.items():
+        if filename not in known:
+            continue
+        old_size, old_mtime, old_hash, upload_status = known[filename]
+        if (old_size, old_mtime) == (size, mtime):
+            continue
+        if upload_status not in TRACKED_STATES:
+            updated[filename] = {'size': size, 'mtime': mtime}  # still pending anyway
+            continue
+        try:
+            digest = file_hash(os.path.join(subdir_path, filename))
+        except OSError as e:
+            logging.warning(f"Could not read {filename}: {e}")
+            continue
+        if old_size is None or digest == old_hash:
+            # first fingerprint (e.g. imported from inventory.json), or only touched
+            updated[filename] = {'size': size, 'mtime': mtime, 'hash': digest}
+        else:
+            updated[filename] = {'size': size, 'mtime': mtime, 'hash': digest, 'parse_status': None, 'upload_status': None}
+            modified.append(filename)
+    return updated, sorted(modified)
+
+async def scan_survey_dir(survey_dir, store, comp_type='', force=False) -> tuple[dict, dict, dict]:
+    """Incrementally scan survey_dir/<component type>/ for added, modified and removed survey files.
+
+    Subdirectories whose mtime matches the one recorded at the last scan are skipped without listing them,
+    since adding, removing or renaming a file always changes the mtime of its directory.
+    The changes found are recorded in the store; new files are added as pending, and files whose contents changed
+    (see `compare_fingerprints`) are reset to pending so that they are processed again.
+    Editing a file in place does not change the mtime of its directory. Use force to find such edits, or `check_files`
+    on the paths reported by file system events.
+
+    Parameters:
+    - survey_dir (str): The `ogp_survey_dir` directory.
+    - store (InventoryStore): Inventory holding the known files and directory mtimes.
+    - comp_type (str): Only scan this subdirectory if given.
+    - force (bool): List every subdirectory, even if its mtime is unchanged.
+
+    Return
+    - dict: {comp_type: [files]} added since the last scan.
+    - dict: {comp_type: [files]} modified since they were processed.
+    - dict: {comp_type: [files]} removed since the last scan."""
+    # wait for another uploader's scan without blocking the event loop
+    async with store.lock():
+        return _scan_survey_dir(survey_dir, store, comp_type, force)
+
+def _scan_survey_dir(survey_dir, store, comp_type, force):
+    added, modified, removed = {}, {}, {}
+    known_mtimes = store.dir_mtimes()
+    found = set()
+    now = time.time()
+    with os.scandir(survey_dir) as subdirs:
+        for subdir in subdirs:
+            if not subdir.is_dir() or (comp_type and subdir.name != comp_type):
+                continue
+            found.add(subdir.name)
+            dir_mtime = subdir.stat().st_mtime
+            if not force and known_mtimes.get(subdir.name) == dir_mtime:
+                logging.debug(f"Skipping unchanged directory {subdir.path}")
+                continue
+
+            files = list_survey_files(subdir.path)
+            known = store.fingerprints(subdir.name)
+            new_files = {name: stat for name, stat in files.items() if name not in known}
+            removed_files = sorted(known.keys() - files.keys())
+            updated_files, modified_files = compare_fingerprints(subdir.path, files, known)
+            racy = now - dir_mtime < RACY_SECONDS
+            store.apply_scan(subdir.name, new_files, removed_files, None if racy else dir_mtime, updated_files)
+
+            if new_files or removed_files or modified_files:
+                logging.info(f"\nChanges in subdirectory '{subdir.name}':")
+            if new_files:
+                added[subdir.name] = sorted(new_files)
+                logging.info(f"  + Added: {', '.join(added[subdir.name])}")
+            if modified_files:
+                modified[subdir.name] = modified_files
+                logging.info(f"  ~ Modified: {', '.join(modified_files)}")
+            if removed_files:
+                removed[subdir.name] = removed_files
+                logging.info(f"  - Removed: {', '.join(removed_files)}")
+
+    # subdirectories that were removed altogether
+    for subdir in known_mtimes.keys() | set(store.comp_types()):
+        if subdir in found or (comp_type and subdir != comp_type):
+            continue
+        files = sorted(store.filenames(subdir))
+        store.remove_dir(subdir)
+        if files:
+            removed[subdir] = files
+    return added, modified, removed
+
+async def check_files(survey_dir, store, paths) -> dict:
+    """Compare the fingerprints of specific survey files, e.g. those reported by file system events.
+
+    Return
+    - dict: {comp_type: [files]} modified since they were processed. They are reset to pending."""
+    by_subdir = {}
+    for path in paths:
+        subdir_path, filename = os.path.split(path)
+        if os.path.dirname(os.path.normpath(subdir_path)) != os.path.normpath(survey_dir) or not is_survey_file(filename):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        by_subdir.setdefault(subdir_path, {})[filename] = (stat.st_size, stat.st_mtime)
+
+    modified = {}
+    for subdir_path, files in by_subdir.items():
+        comp_type = os.path.basename(subdir_path)
+        async with store.lock():
+            updated_files, modified_files = compare_fingerprints(subdir_path, files, store.fingerprints(comp_type))
+            if updated_files:
+                store.record_files(comp_type, updated_files)
+        if modified_files:
+            modified[comp_type] = modified_files
+            logging.info(f"Modified in '{comp_type}': {', '.join(modified_files)}")
+    return modified
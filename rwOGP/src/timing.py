@@ -0,0 +1,117 @@
+import os, csv, json, time, threading
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+# Timed steps of processing one survey, in report order. 'process' is the time from the start of the
+# offset calculation to the end of the upload, including the time spent waiting in the pipeline.
+STAGES = ('parse', 'fd_extraction', 'offsets', 'render_heights', 'render_fd', 'render_accuracy', 'db_check', 'db_insert', 'process')
+
+# Upper edges (seconds) of the histogram buckets in the run report; the last bucket is open
+HISTOGRAM_EDGES = (0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0)
+
+class RunTimer():
+    """Collect per-survey timings of the processing stages (see `STAGES`) during a run, and summarize them
+    in a run report. Safe to use from worker threads.
+
+    Each attempt at processing a survey is timed separately, e.g. when it is processed again after an edit or
+    its upload is retried, so that repeated work does not add up in one entry. A long-lived timer (e.g. in watch
+    mode) keeps only the latest `max_entries` attempts."""
+    def __init__(self, max_entries=None):
+        """Parameters:
+        - max_entries (int): Number of attempts kept, the oldest are dropped first. None keeps all of them."""
+        self.started = datetime.now()
+        self.max_entries = max_entries
+        self.timings = {}    # {(survey source, attempt): {stage: seconds}}, oldest first
+        self._attempts = {}  # {survey source: number of its current attempt}
+        self._lock = threading.Lock()
+
+    def start(self, source):
+        """Start a new attempt at processing source. The timings added for source from now on go to it."""
+        with self._lock:
+            attempt = self._attempts.get(source, 0) + 1
+            self._attempts[source] = attempt
+            self.timings[(source, attempt)] = {}
+            self._trim()
+
+    def _trim(self):
+        while self.max_entries is not None and len(self.timings) > self.max_entries:
+            source, attempt = next(iter(self.timings))
+            del self.timings[(source, attempt)]
+            if self._attempts.get(source) == attempt:
+                del self._attempts[source]
+
+    def add(self, source, stage, seconds):
+        with self._lock:
+            key = (source, self._attempts.setdefault(source, 1))
+            survey = self.timings.setdefault(key, {})
+            survey[stage] = survey.get(stage, 0.0) + seconds
+            self._trim()
+
+    def add_many(self, source, timings: dict):
+        for stage, seconds in timings.items():
+            self.add(source, stage, seconds)
+
+    @contextmanager
+    def time(self, source, stage):
+        """Time the body of a with block as stage of source."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(source, stage, time.perf_counter() - start)
+
+    def stages(self) -> list:
+        """Timed stages, known stages first."""
+        seen = {stage for survey in self.timings.values() for stage in survey}
+        return [stage for stage in STAGES if stage in seen] + sorted(seen - set(STAGES))
+
+    def summary(self) -> dict:
+        """Return {stage: statistics} with the count, total, mean, percentiles, maximum and histogram of each stage."""
+        summary = {}
+        for stage in self.stages():
+            values = np.array([survey[stage] for survey in self.timings.values() if stage in survey])
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            counts = np.histogram(values, bins=(0.0, *HISTOGRAM_EDGES, np.inf))[0]
+            summary[stage] = {'count': len(values), 'total': float(values.sum()), 'mean': float(values.mean()),
+                              'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(values.max()),
+                              'histogram': {f"<{edge:g}s": int(count) for edge, count in zip(HISTOGRAM_EDGES, counts)}
+                                           | {f">={HISTOGRAM_EDGES[-1]:g}s": int(counts[-1])}}
+        return summary
+
+    def write_report(self, report_dir, name='run_report') -> tuple[str, str]:
+        """Write the timings of every attempt to report_dir/name.csv and the summary with the timings to name.json.
+
+        Return
+        - str, str: Paths of the json and csv reports."""
+        os.makedirs(report_dir, exist_ok=True)
+        stages = self.stages()
+        with self._lock:
+            timings = list(self.timings.items())
+        json_path, csv_path = os.path.join(report_dir, f"{name}.json"), os.path.join(report_dir, f"{name}.csv")
+        with open(json_path, 'w') as f:
+            json.dump({'started': self.started.isoformat(timespec='seconds'), 'finished': datetime.now().isoformat(timespec='seconds'),
+                       'surveys': self.surveys(), 'attempts': len(timings), 'summary': self.summary(),
+                       'timings': [{'survey': source, 'attempt': attempt, 'stages': survey} for (source, attempt), survey in timings]},
+                      f, indent=2)
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['survey', 'attempt', *stages])
+            for (source, attempt), survey in timings:
+                writer.writerow([source, attempt, *(f"{survey[stage]:.6f}" if stage in survey else '' for stage in stages)])
+        return json_path, csv_path
+
+    def surveys(self) -> int:
+        """Number of surveys with timed attempts."""
+        return len({source for source, _ in self.timings})
+
+    def print_summary(self):
+        """Print a table with the percentiles of the stage timings."""
+        table = Table(title=f"Stage Timings ({self.surveys()} surveys, {len(self.timings)} attempts, seconds)", show_header=True, header_style="bold magenta")
+        for column in ["Stage", "Count", "Mean", "p50", "p90", "p99", "Max", "Total"]:
+            table.add_column(column, justify="left" if column == "Stage" else "right")
+        for stage, stats in self.summary().items():
+            table.add_row(stage, str(stats['count']), *(f"{stats[key]:.3f}" for key in ('mean', 'p50', 'p90', 'p99', 'max', 'total')))
+        Console().print(table)
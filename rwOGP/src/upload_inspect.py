@@ -1,11 +1,38 @@
-import sys, asyncpg, logging
+import sys, time, inspect, asyncio, asyncpg, logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
 sys.path.append('../')
 
-from src.param import COMP_PREFIX
+from src.param import COMP_PREFIX, COMPONENT_PARAMS
 
 class MissingEntryException(Exception):
     pass
 
+class TTLCache():
+    """Small cache whose entries expire ttl seconds after they were stored. A ttl of 0 disables it."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # {key: (value, expiry time)}
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if entry[1] < time.monotonic():
+            del self._entries[key]
+            return default
+        return entry[0]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def set(self, key, value):
+        if self.ttl > 0:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def clear(self):
+        self._entries.clear()
+
 def get_query_read(component_type, part_name = None, limit=15) -> str:
     """Get the query to read from the database.
 
@@ -19,7 +46,8 @@ def get_query_read(component_type, part_name = None, limit=15) -> str:
         query = f"""SELECT hexplot FROM {prefix}_inspect WHERE {prefix}_name = '{part_name}'"""
     return query
 
-def get_query_write(table_name, column_names) -> str:
+@lru_cache(maxsize=64)
+def get_query_write(table_name, column_names: tuple) -> str:
     """Get the query to write to the database.
     
     Returns:
@@ -29,64 +57,66 @@ def get_query_write(table_name, column_names) -> str:
     query = f"""{pre_query} {'({})'.format(data_placeholder)}"""
     return query
 
-def get_query_write_link(comp_params, db_dict) -> tuple[str, str, str, list]:
-    """Get queries to link a component to its mother table and write to the database.
+@lru_cache(maxsize=64)
+def get_query_link_insert(table_name, mother_table, prefix, column_names: tuple) -> str:
+    """Get the query linking a component to its mother table and writing it to the database in one statement.
+    The component is inserted with the {prefix}_no of its mother table entry, or without link (NULL) if it has none.
+    The query text only depends on the table and the columns, so that it is built once, and asyncpg prepares it once
+    per connection (see the statement cache of `asyncpg.connect`).
+
     Parameters:
-    - comp_params (dict): Component parameters including prefix and mother table info.
-    - db_dict (dict): Data to be uploaded to the database.
-    Returns:
-    - pre_query (str): Query to verify component exists in mother table.
-    - comp_name_val (str): Component name/ID value.
-    - query (str): Main insertion query.
-    - column_values (list): Values to be inserted.
-
-    Raises:
-    - MissingEntryException: If component ID column is not in the data."""
-
-    # Extract basic parameters
-    prefix = comp_params['prefix']
-    mother_table = comp_params['mother_table']
-    table_name = f"{prefix}_inspect"
-
-    # Define column names
-    number_col = f"{prefix}_no"
-    comp_name_col = f"{prefix}_name"
-    column_names = list(db_dict.keys())
-    column_values = list(db_dict.values())
-
-    # Verify component name exists in data
-    if comp_name_col not in column_names:
-        raise MissingEntryException(
-            f"Component ID not provided in data. Column names must contain {comp_name_col}."
-        )
-
-    # Get component name value and its position in the data
-    comp_name_val = db_dict[comp_name_col]
-    comp_name_position = f"${column_names.index(comp_name_col) + 1}"
-
-    # Generate the existence check query
-    pre_query = f"""
-    SELECT EXISTS (
-        SELECT 1
-        FROM {mother_table}
-        WHERE {comp_name_col} = $1
-    );"""
+    - column_names (tuple): Columns of the data, bound in this order to $1, $2, ...; must contain {prefix}_name.
 
+    Returns:
+    - query (str): Query returning one row, (linked: bool, {prefix}_no of the mother table entry, inserted: int)."""
+    number_col, comp_name_col = f"{prefix}_no", f"{prefix}_name"
     placeholders = [f"${i + 1}" for i in range(len(column_names))]
-    query = f"""
-    INSERT INTO {table_name} ({number_col}, {', '.join(column_names)})
-    SELECT {mother_table}.{number_col}, {', '.join(placeholders)}
-    FROM {mother_table}
-    WHERE {mother_table}.{comp_name_col} = {comp_name_position};
-    """
-    # WHERE REPLACE({mother_table}.{comp_name_col}, '-', '_') = {comp_name_position};
-    return pre_query, comp_name_val, query, column_values
+    comp_name_position = placeholders[column_names.index(comp_name_col)]
+    return f"""
+    WITH mother AS (
+        SELECT {number_col} FROM {mother_table} WHERE {comp_name_col} = {comp_name_position}
+    ), inserted AS (
+        INSERT INTO {table_name} ({number_col}, {', '.join(column_names)})
+        SELECT mother.{number_col}, {', '.join(placeholders)}
+        FROM (VALUES (1)) AS one LEFT JOIN mother ON TRUE
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM mother) AS linked, (SELECT min({number_col}) FROM mother) AS number,
+           (SELECT count(*) FROM inserted) AS inserted;"""
+
+# Errors worth retrying later: the server is unreachable, restarting or overloaded, or the transaction lost a race
+TRANSIENT_DB_ERRORS = (OSError, asyncio.TimeoutError,
+                       asyncpg.exceptions.PostgresConnectionError,
+                       asyncpg.exceptions.ConnectionDoesNotExistError,
+                       asyncpg.exceptions.CannotConnectNowError,
+                       asyncpg.exceptions.TooManyConnectionsError,
+                       asyncpg.exceptions.DeadlockDetectedError,
+                       asyncpg.exceptions.SerializationError)
+
+async def _keep_session(conn):
+    """Pool connection reset that skips the reset query (RESET ALL, UNLISTEN *, ...), a round trip after every query.
+    asyncpg still rolls back an open transaction; DBClient changes no other session state."""
+
+# asyncpg >= 0.30 lets the pool replace the reset query
+_POOL_OPTIONS = {'reset': _keep_session} if 'reset' in inspect.signature(asyncpg.create_pool).parameters else {}
+
+def proto_name(name: str) -> str:
+    """Name of the protomodule of a module, e.g. 320MLF3W2CM0121 -> 320PLF3W2CM0121, keeping the case of the other characters.
+    Protomodule names are returned as they are. Upper case it for keys of offsets by protomodule."""
+    index = name.upper().find('ML')
+    return name if index < 0 else name[:index] + 'PL' + name[index + 2:]
 
 class DBClient():
+    """Database client. Queries share a pool of connections, opened on first use and kept until `close`:
+
+        async with DBClient(config) as client:
+            await client.link_and_update_table(comp_params, db_upload_data)"""
     def __init__(self, config):
         """Initialize the database client.
         Parameters:
-        - config: a loaded yaml configuration object."""
+        - config: a loaded yaml configuration object. `db_pool_min_size` and `db_pool_max_size` set the number of
+        connections kept open and the most opened at the same time. `mother_cache_seconds` sets how long the mother
+        table entries of components are remembered."""
         self.host = config['host']
         self.database = config['database']
         self.user = config['user']
@@ -97,27 +127,95 @@ class DBClient():
             'database': self.database,
             'user': self.user,
             'password': self.password}
+        self.pool_min_size = max(0, int(config.get('db_pool_min_size', 1)))
+        self.pool_max_size = max(1, self.pool_min_size, int(config.get('db_pool_max_size', 4)))
+        self._pool = None
+        self._pool_loop = None      # event loop the pool belongs to
+        self._pool_creating = None  # future of the pool being created, shared by concurrent first queries
+        # {(mother table, component name): (in mother table, its {prefix}_no)}, see `mother_entries`
+        self.mother_cache = TTLCache(config.get('mother_cache_seconds', 300))
+        self.sensor_offsets = {}  # {protomodule name (upper case): offsets or None}, cleared by the caller for each run
+
+    async def pool(self) -> asyncpg.Pool:
+        """Return the connection pool, created on first use. A pool belongs to one event loop, so a new one is
+        created when called from another loop, e.g. by the GUI, which runs every request with asyncio.run."""
+        loop = asyncio.get_running_loop()
+        if self._pool_loop is not loop:
+            self._terminate()
+            self._pool_loop = loop
+        if self._pool is None:
+            if self._pool_creating is None:
+                logging.debug(f"Opening a pool of {self.pool_min_size}-{self.pool_max_size} database connections")
+                self._pool_creating = asyncio.ensure_future(asyncpg.create_pool(
+                    min_size=self.pool_min_size, max_size=self.pool_max_size, **_POOL_OPTIONS, **self._connect_params))
+            creating = self._pool_creating
+            try:
+                pool = await asyncio.shield(creating)
+            except Exception:
+                if self._pool_creating is creating:
+                    self._pool_creating = None  # e.g. the server is unreachable; try again on the next query
+                raise
+            if self._pool is None:
+                self._pool = pool
+        return self._pool
+
+    @asynccontextmanager
+    async def connection(self):
+        """Acquire a connection from the pool for the body of an async with block."""
+        pool = await self.pool()
+        async with pool.acquire() as conn:
+            yield conn
+
+    def _terminate(self):
+        """Drop the pool of another, possibly closed, event loop."""
+        pool, self._pool, self._pool_creating = self._pool, None, None
+        if pool is not None:
+            try:
+                pool.terminate()
+            except Exception as e:
+                logging.debug(f"Failed to terminate the database connection pool: {e}")
+
+    async def close(self):
+        """Close the pooled connections. A later query opens a new pool."""
+        if self._pool_loop is not asyncio.get_running_loop():
+            self._terminate()
+            return
+        pool, creating = self._pool, self._pool_creating
+        self._pool, self._pool_creating = None, None
+        if pool is None and creating is not None:
+            try:
+                pool = await creating
+            except Exception:
+                pool = None
+        if pool is not None:
+            await pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
 
     async def fetch_PostgreSQL(self, query):
-        conn = await asyncpg.connect(**self._connect_params)
-        value = await conn.fetch(query)
-        await conn.close()
-        return value
+        async with self.connection() as conn:
+            return await conn.fetch(query)
 
     async def request_PostgreSQL(self, component_type, bp_name = None):
         """Request data from the database."""
         result = await self.fetch_PostgreSQL(get_query_read(component_type, bp_name))
         return result
 
-    async def upload_PostgreSQL(self, comp_params, db_upload_data) -> bool:
+    async def upload_PostgreSQL(self, comp_params, db_upload_data, conn=None) -> bool:
         """Upload data to the database. Return True if successful, False otherwise.
 
         Parameters:
         - table_name (str): Name of the table to upload data to.
-        - db_upload_data (dict): Dictionary containing the data to upload."""
+        - db_upload_data (dict): Dictionary containing the data to upload.
+        - conn: Connection to use, e.g. one already acquired by the caller. One from the pool if not given."""
+        if conn is None:
+            async with self.connection() as conn:
+                return await self.upload_PostgreSQL(comp_params, db_upload_data, conn)
         try:
-            conn = await asyncpg.connect(**self._connect_params)
-            logging.debug('Connection successful. \n')
             table_name = comp_params['db_table_name']
 
             schema_name = 'public'
@@ -132,62 +230,202 @@ class DBClient():
             logging.debug(f"Attempting to upload to Table {table_name}...")
             table_exists = await conn.fetchval(table_exists_query, schema_name, table_name)  ### Returns True/False
             if table_exists:
-                query = get_query_write(table_name, db_upload_data.keys())
+                query = get_query_write(table_name, tuple(db_upload_data))
                 await conn.execute(query, *db_upload_data.values())
                 logging.info(f'Data successfully uploaded to the {table_name}!')
                 return True
             else:
                 logging.warning(f'Table {table_name} does not exist in the database. Please create the table before uploading data.')
                 return False
+        except TRANSIENT_DB_ERRORS:
+            raise
         except Exception as e:
             logging.error(f"Error encountered when uploading to the database: {e}")
             return False
-        finally: 
-            await conn.close()
 
-    async def link_and_update_table(self, comp_params, db_upload_data) -> bool:
-        """Link the component to the mother table and update the database. Return True if successful, False otherwise."""
-        conn = await asyncpg.connect(**self._connect_params)
-        try:
-            prequery, name, query, values = get_query_write_link(comp_params, db_upload_data)
-            logging.debug("Executing pre-query...")
-            status = await conn.fetchval(prequery, name)
-            if not status:
-                logging.warning(f"Component {name} not found in the mother table {comp_params['mother_table']}.")
-                await self.upload_PostgreSQL(comp_params, db_upload_data)
-                logging.info(f"Component {name} uploaded without linking to the mother table.")
-            else:
-                await conn.execute(query, *values)
-                logging.info('Data successfully uploaded!')
-            return True
-        except Exception as e:
-            logging.error(f"Error encountered when linking to the mother table: {e}")
+    async def link_and_update_table(self, comp_params, db_upload_data, timings: dict = None) -> bool:
+        """Link the component to the mother table and update the database, in one round trip (see `get_query_link_insert`).
+        Return True if successful, False otherwise.
+        If timings is given, the seconds spent linking and inserting are stored as 'db_insert'."""
+        timings = {} if timings is None else timings
+        comp_name_col = f"{comp_params['prefix']}_name"
+        if comp_name_col not in db_upload_data:
+            logging.error(f"Component ID not provided in data. Column names must contain {comp_name_col}.")
             return False
-        
+        name = db_upload_data[comp_name_col]
+        cache_key = (comp_params['mother_table'], name)
+        cached = self.mother_cache.get(cache_key)
+        async with self.connection() as conn:
+            try:
+                start = time.perf_counter()
+                if cached is not None:  # mother table entry known, e.g. from `prefetch_mother_entries`
+                    linked, number = cached
+                    columns = (f"{comp_params['prefix']}_no", *db_upload_data)
+                    await conn.execute(get_query_write(comp_params['db_table_name'], columns), number, *db_upload_data.values())
+                else:
+                    query = get_query_link_insert(comp_params['db_table_name'], comp_params['mother_table'], comp_params['prefix'], tuple(db_upload_data))
+                    linked, number, _ = await conn.fetchrow(query, *db_upload_data.values())
+                    self.mother_cache.set(cache_key, (linked, number))
+                timings['db_insert'] = time.perf_counter() - start
+            except TRANSIENT_DB_ERRORS:
+                raise
+            except Exception as e:
+                logging.error(f"Error encountered when linking to the mother table: {e}")
+                return False
+        if linked:
+            logging.info('Data successfully uploaded!')
+        else:
+            logging.warning(f"Component {name} not found in the mother table {comp_params['mother_table']}.")
+            logging.info(f"Component {name} uploaded without linking to the mother table.")
+        return True
+
+    async def mother_entries(self, requests: list, conn=None) -> dict:
+        """Look up components in their mother tables. Entries found in `mother_cache` cost nothing; the others of all
+        mother tables are fetched with one query and cached.
+
+        Parameters:
+        - requests (list): (comp_params, component names) pairs, e.g. one per component type.
+        - conn: Connection to use. One from the pool if not given.
+
+        Returns:
+        - dict: {(mother table, name): (in mother table, its {prefix}_no or None)} for all requested names."""
+        entries, missing = {}, []
+        for comp_params, names in requests:
+            mother_table = comp_params['mother_table']
+            names = [name for name in dict.fromkeys(names) if name is not None]
+            for name in names:
+                cached = self.mother_cache.get((mother_table, name))
+                if cached is not None:
+                    entries[(mother_table, name)] = cached
+            names = [name for name in names if (mother_table, name) not in entries]
+            if names:
+                missing.append((comp_params, names))
+        if not missing:
+            return entries
+        if conn is None:
+            async with self.connection() as conn:
+                return entries | await self.mother_entries(missing, conn)
+        selects = [f"SELECT {i}, {comp_params['prefix']}_name::text, {comp_params['prefix']}_no::bigint "
+                   f"FROM {comp_params['mother_table']} WHERE {comp_params['prefix']}_name = ANY(${i + 1}::text[])"
+                   for i, (comp_params, _) in enumerate(missing)]
+        rows = await conn.fetch(' UNION ALL '.join(selects), *(names for _, names in missing))
+        found = {(missing[i][0]['mother_table'], name): number for i, name, number in rows}
+        for comp_params, names in missing:
+            for name in names:
+                key = (comp_params['mother_table'], name)
+                entries[key] = (key in found, found.get(key))
+                self.mother_cache.set(key, entries[key])
+        return entries
+
+    async def prefetch_mother_entries(self, names: dict):
+        """Look up all components of a batch in their mother tables with one query (see `mother_entries`), so that
+        their uploads do not check the mother tables again while the entries are cached.
+
+        Parameters:
+        - names (dict): {component type (e.g. module): component names}."""
+        requests = [(COMPONENT_PARAMS[comp_type], comp_names) for comp_type, comp_names in names.items() if comp_names]
+        if requests and self.mother_cache.ttl > 0:
+            entries = await self.mother_entries(requests)
+            logging.debug(f"{sum(linked for linked, _ in entries.values())} of {len(entries)} components found in their mother tables.")
+
+    async def upload_batch(self, comp_params, rows: list, timings: dict = None) -> list:
+        """Upload many components of one type in one transaction. The mother table numbers of all of them are looked up
+        with at most one query, then the rows are streamed to the table with COPY (executemany if COPY fails). Components not in
+        the mother table are inserted without link, like `link_and_update_table` does. On any error the whole batch is
+        rolled back and the error raised.
+
+        Parameters:
+        - comp_params (dict): Component parameters including prefix and mother table info.
+        - rows (list): Dictionaries of data to upload, one per component, as for `link_and_update_table`.
+        - timings (dict): If given, the seconds spent on the whole batch checking the mother table (none if cached, see
+          `mother_entries`) and inserting are stored as 'db_check' and 'db_insert'.
+
+        Returns:
+        - list: For each row, True if it was linked to the mother table.
+
+        Raises:
+        - MissingEntryException: If the component ID column is missing from a row."""
+        timings = {} if timings is None else timings
+        prefix, mother_table = comp_params['prefix'], comp_params['mother_table']
+        table_name = comp_params['db_table_name']
+        number_col, comp_name_col = f"{prefix}_no", f"{prefix}_name"
+        for row in rows:
+            if comp_name_col not in row:
+                raise MissingEntryException(f"Component ID not provided in data. Column names must contain {comp_name_col}.")
+        names = list({row[comp_name_col] for row in rows})
+        groups = {}  # rows with the same columns are copied together
+        for row in rows:
+            groups.setdefault(tuple(row), []).append(row)
+
+        async with self.connection() as conn:
+            async with conn.transaction():
+                start = time.perf_counter()
+                entries = await self.mother_entries([(comp_params, names)], conn)
+                numbers = {name: number for (_, name), (linked, number) in entries.items() if linked}
+                timings['db_check'] = time.perf_counter() - start
+                start = time.perf_counter()
+                for columns, group in groups.items():
+                    columns = [number_col, *columns]
+                    records = [(numbers.get(row[comp_name_col]), *row.values()) for row in group]
+                    try:
+                        async with conn.transaction():
+                            await conn.copy_records_to_table(table_name, records=records, columns=columns)
+                    except TRANSIENT_DB_ERRORS:
+                        raise
+                    except Exception as e:
+                        logging.warning(f"COPY to {table_name} failed ({e}), inserting with executemany instead.")
+                        await conn.executemany(get_query_write(table_name, tuple(columns)), records)
+                timings['db_insert'] = time.perf_counter() - start
+        missing = sorted(name for name in names if name not in numbers)
+        if missing:
+            logging.warning(f"Components {', '.join(missing)} not found in the mother table {mother_table}, uploaded without linking.")
+        logging.info(f"{len(rows)} components successfully uploaded to {table_name}!")
+        return [row[comp_name_col] in numbers for row in rows]
+
     async def GrabSensorOffsets(self, name: str) -> tuple[float, float, float]:
-        """Grab the sensor offsets (PM offset numbers) from the database.
+        """Grab the sensor offsets (PM offset numbers) from the database, or from `sensor_offsets` if already fetched
+        in this run (see `GrabSensorOffsetsBatch`).
         
         Parameters:
         - name (str): Name of the prototype module.
 
         Returns:
         - tuple[float, float, float]: x_offset, y_offset, angle_offset for the module."""
-        conn = None
         try:
-            conn = await asyncpg.connect(**self._connect_params)
-            query = """SELECT x_offset_mu, y_offset_mu, ang_offset_deg
-                        FROM proto_inspect
-                        WHERE LOWER(proto_name) = LOWER($1)
-                        ORDER BY proto_row_no DESC
-                        LIMIT 1;"""
-            # Order by row number descending to get the most recent entry
-            row = await conn.fetchrow(query, name.replace('ML', 'PL', 1))
-            return row['x_offset_mu'], row['y_offset_mu'], row['ang_offset_deg']
+            key = proto_name(name).upper()
+            if key not in self.sensor_offsets:
+                await self.GrabSensorOffsetsBatch([name])
+            offsets = self.sensor_offsets[key]
+            if offsets is None:
+                raise MissingEntryException(f"No entry for {proto_name(name)} in proto_inspect.")
+            return offsets
         except Exception as e:
             logging.error("Error encountered when grabbing Protomodule offsets from database.")
             logging.error("Accuracy Plot: PM offsets set to 0, 0, 0, due to failed data pull.")
             logging.error(e)
             return 0.0, 0.0, 0.0
-        finally:
-            if conn:
-                await conn.close()
+
+    async def GrabSensorOffsetsBatch(self, names: list) -> dict:
+        """Grab the latest sensor offsets of the protomodules of many modules with one query, and remember them in
+        `sensor_offsets` for `GrabSensorOffsets`. Names are matched exactly (as given or upper case), so that an index
+        on proto_name can be used.
+
+        Parameters:
+        - names (list): Names of modules (ML) or prototype modules (PL).
+
+        Returns:
+        - dict: {name: (x_offset, y_offset, angle_offset), or None if the protomodule has no entry}."""
+        keys = {name: proto_name(name).upper() for name in names if name}
+        candidates = list({variant for name in keys for variant in (proto_name(name), keys[name])})
+        if candidates:
+            query = """SELECT DISTINCT ON (UPPER(proto_name)) UPPER(proto_name), x_offset_mu, y_offset_mu, ang_offset_deg
+                        FROM proto_inspect
+                        WHERE proto_name = ANY($1::text[])
+                        ORDER BY UPPER(proto_name), proto_row_no DESC;"""
+            # Order by row number descending to get the most recent entry of each protomodule
+            async with self.connection() as conn:
+                rows = await conn.fetch(query, candidates)
+            found = {key: tuple(offsets) for key, *offsets in rows}
+            for key in set(keys.values()):
+                self.sensor_offsets[key] = found.get(key)
+        return {name: self.sensor_offsets.get(key) for name, key in keys.items()}
@@ -0,0 +1,132 @@
+import os, time, asyncio, logging
+from .survey_scan import scan_survey_dir, check_files
+
+pjoin = os.path.join
+
+class SurveyWatcher():
+    """Watch `ogp_survey_dir/<component type>` and upload new survey files once they are completely written.
+
+    File system events come from the optional `watchdog` package (inotify on Linux). Without it the
+    survey directory is polled; polling is cheap since unchanged subdirectories are only stat'ed (see `scan_survey_dir`).
+    Surveys edited in place are found from the events, and by listing every subdirectory every `rescan_interval` seconds."""
+    def __init__(self, updater, interval=5.0, settle_seconds=2.0, rescan_interval=3600.0):
+        """Parameters:
+        - updater (InventoryUpdater): Updater whose parse/process/upload path new files are fed through.
+        - interval (float): Seconds between polls of the survey directory (without events).
+        - settle_seconds (float): A file is processed once its size and mtime have not changed for this long.
+        - rescan_interval (float): Seconds between scans of every subdirectory, also unchanged ones. None or 0 to never rescan."""
+        self.updater = updater
+        self.interval = interval
+        self.settle_seconds = settle_seconds
+        self.rescan_interval = rescan_interval
+        self._seen = {}       # {path: ((size, mtime), monotonic time first seen with that signature)}
+        self._attempted = {}  # {path: (size, mtime)} of files already fed to the uploader in this session
+        self._wake = None
+        self._changed = set()  # paths reported by file system events since the last poll
+        self._last_rescan = time.monotonic()
+
+    def _start_observer(self, loop):
+        """Start a watchdog observer that wakes the watch loop on file system events. Return None if watchdog is unavailable."""
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            logging.info(f"watchdog is not installed, polling {self.updater.checkdir} every {self.interval} seconds.")
+            return None
+
+        wake, changed = self._wake, self._changed
+        class WakeHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                for path in (event.src_path, getattr(event, 'dest_path', None)):
+                    if path and not event.is_directory:
+                        loop.call_soon_threadsafe(changed.add, os.fsdecode(path))
+                loop.call_soon_threadsafe(wake.set)
+
+        observer = Observer()
+        observer.schedule(WakeHandler(), self.updater.checkdir, recursive=True)
+        observer.start()
+        logging.info(f"Watching {self.updater.checkdir} for file system events.")
+        return observer
+
+    def ready_files(self, pending: dict) -> dict:
+        """Select the pending files that have stopped growing.
+
+        Parameters:
+        - pending (dict): {comp_type: [files]} not uploaded yet.
+
+        Return
+        - dict: {comp_type: [files]} whose size and mtime were unchanged for `settle_seconds`.
+        Files that failed in this session are only tried again once they change."""
+        now = time.monotonic()
+        ready = {}
+        paths = set()
+        for subdir, files in pending.items():
+            for filename in files:
+                path = pjoin(self.updater.checkdir, subdir, filename)
+                paths.add(path)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime)
+                if self._attempted.get(path) == signature:
+                    continue
+                seen = self._seen.get(path)
+                if seen is None or seen[0] != signature:
+                    self._seen[path] = (signature, now)
+                    continue
+                if now - seen[1] >= self.settle_seconds and time.time() - stat.st_mtime >= self.settle_seconds:
+                    ready.setdefault(subdir, []).append(filename)
+        # forget files that were uploaded or removed meanwhile
+        self._seen = {path: seen for path, seen in self._seen.items() if path in paths}
+        self._attempted = {path: signature for path, signature in self._attempted.items() if path in paths}
+        return ready
+
+    async def poll_once(self) -> bool:
+        """Scan for changes and upload the files that are ready.
+
+        Return
+        - bool: True if some new files are still being written."""
+        updater = self.updater
+        rescan = bool(self.rescan_interval) and time.monotonic() - self._last_rescan >= self.rescan_interval
+        if rescan:
+            self._last_rescan = time.monotonic()
+        _, _, removed = await scan_survey_dir(updater.checkdir, updater.store, updater.comp_type, force=rescan)
+        # surveys edited in place do not change their directory, but are reported by file system events
+        changed = list(self._changed)
+        self._changed.clear()
+        await check_files(updater.checkdir, updater.store, changed)
+        for subdir, files in removed.items():
+            logging.warning(f"Removed from {subdir}: {', '.join(files)}")
+        ready = self.ready_files(updater.store.pending(updater.comp_type))
+        if ready:
+            for subdir, files in ready.items():
+                for filename in files:
+                    path = pjoin(updater.checkdir, subdir, filename)
+                    self._attempted[path] = self._seen.pop(path)[0]
+            await updater.upload_and_update(ready)
+        return bool(self._seen)
+
+    async def run(self, max_polls=None):
+        """Watch until interrupted (or for max_polls polls)."""
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        observer = self._start_observer(loop)
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                self._wake.clear()
+                settling = await self.poll_once()
+                polls += 1
+                # poll again soon while files are being written; otherwise wait for an event or the next poll
+                timeout = min(self.interval, self.settle_seconds) if settling else self.interval
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                    # let a burst of events (e.g. a file being written) pass before scanning
+                    await asyncio.sleep(min(0.5, self.settle_seconds))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
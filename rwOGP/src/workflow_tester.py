@@ -4,7 +4,7 @@ import pandas as pd
 
 pjoin = os.path.join
 
-from src.parse_data import DataParser
+from src.parse_data import DataParser, load_parsed_survey
 from src.ogp_height_plotter import PlotTool
 from src.param import modules_params as component_params
 from src.param import pin_mapping
@@ -20,13 +20,11 @@ def test_angle_calculations(sample_path, comp_type):
     parser = DataParser(sample_path, 'tests')
     meta, features = parser()
 
-    with open(meta[0], 'r') as f:
-        metadata = yaml.safe_load(f)
-        
+    metadata, feature_df = load_parsed_survey(features[0], meta[0])
+
     setup_logging(level=logging.INFO)
     sample_name = os.path.basename(sample_path)
     logging.info(f"Running comparison for {sample_name} with component type {comp_type}")
-    feature_df = pd.read_csv(features[0])
     
     # Get results from new implementation (PlotTool)
     PT = PlotTool(metadata, comp_type, feature_df, 'rwOGP/templates/trays', 'tests')
@@ -115,12 +113,10 @@ def test_module_workflow(sample_path, comp_type, tray_dir):
     parser = DataParser(sample_path, f'tests/{comp_type}')
     meta, features = parser()
 
-    with open(meta[0], 'r') as f:
-        metadata = yaml.safe_load(f)
-        
+    metadata, feature_df = load_parsed_survey(features[0], meta[0])
+
     setup_logging()
 
-    feature_df = pd.read_csv(features[0])
     PT = PlotTool(metadata, comp_type, feature_df, tray_dir, f'tests/{comp_type}')
     
     im_args = {"vmini":component_params['vmini'], "vmaxi":component_params['vmaxi'], 
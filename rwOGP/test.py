@@ -9,7 +9,7 @@ src_dir = pjoin(file_dir, 'rwOGP')
 if src_dir not in sys.path:
     sys.path.append(src_dir)
 
-from src.parse_data import DataParser
+from src.parse_data import DataParser, load_parsed_survey
 from src.ogp_height_plotter import PlotTool
 from src.param import modules_params as component_params
 from src.param import pin_mapping
@@ -26,12 +26,10 @@ def test_angle_calculations(sample_name, comp_type):
     parser = DataParser(pjoin('rwOGP', 'templates', 'samples', sample_name), 'tests')
     meta, features = parser()
 
-    with open(meta[0], 'r') as f:
-        metadata = yaml.safe_load(f)
-        
+    metadata, feature_df = load_parsed_survey(features[0], meta[0])
+
     setup_logging(level=logging.INFO)
     logging.info(f"Running comparison for {sample_name} with component type {comp_type}")
-    feature_df = pd.read_csv(features[0])
     
     # Get results from new implementation (PlotTool)
     PT = PlotTool(metadata, comp_type, feature_df, 'rwOGP/templates/trays', 'tests')
@@ -120,12 +118,10 @@ def test_workflow(sample_name, comp_type):
     parser = DataParser(pjoin('rwOGP', 'templates', 'samples', sample_name), 'tests')
     meta, features = parser()
 
-    with open(meta[0], 'r') as f:
-        metadata = yaml.safe_load(f)
-        
+    metadata, feature_df = load_parsed_survey(features[0], meta[0])
+
     setup_logging()
 
-    feature_df = pd.read_csv(features[0])
     PT = PlotTool(metadata, comp_type, feature_df, 'rwOGP/templates/trays', 'tests')
     
     im_args = {"vmini":component_params['vmini'], "vmaxi":component_params['vmaxi'], 
@@ -13,6 +13,9 @@ setup(
         "ttp==0.9.5",
         "chardet==4.0.0"
     ],
+    extras_require={                    # Optional: file system events for --watch (polls without it)
+        "watch": ["watchdog>=2.0"],
+    },
     entry_points={                      # Optional: Entry points for command-line scripts
         "console_scripts": [
             "uploadOGPresults=main:main_func",